@@ -5,413 +5,3478 @@ Tandem Technical Test - User Flow Analysis Script
 Processes user events data to identify meaningful flows and anomalies.
 """
 
+import argparse
+import bz2
+import contextlib
+import glob
+import hashlib
+import heapq
+import importlib.util
+import itertools
 import json
+import lzma
+import math
+import mmap
+import os
+import pickle
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import warnings
+import weakref
+import zlib
+from array import array
+from operator import attrgetter, gt, itemgetter
 import requests
-from datetime import datetime
-from collections import defaultdict, Counter
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from fractions import Fraction
+from collections import defaultdict, deque, Counter
 import statistics
-from typing import Dict, List
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for .zst inputs
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:  # Optional, faster JSON decoding
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # Optional, fastest JSON decoding into typed structs
+    msgspec = None
+
+try:
+    import numpy
+except ImportError:  # Optional, vectorized timestamp conversion
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Optional, Parquet and Arrow IPC input and session table output
+    pyarrow = None
+
+DEFAULT_DATA_URL = "https://s3.eu-central-1.amazonaws.com/public.prod.usetandem.ai/sessions.json"
+
+# Size of the byte chunks read from streamed inputs (HTTP bodies, stdin, pipes)
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Byte range fetched by each request of the parallel HTTP downloader
+DEFAULT_RANGE_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Where downloaded payloads are kept between runs, and how much disk they may use
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'user_flow_analyzer')
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Where snapshots of finalized event stores are kept, and how much disk they may use
+DEFAULT_SNAPSHOT_DIR = os.path.join(DEFAULT_CACHE_DIR, 'snapshots')
+DEFAULT_SNAPSHOT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Events sorted in memory before the external sort store writes them out as one run
+DEFAULT_SORT_RUN_SIZE = 1_000_000
+
+# Runs merged at once by the external sort store, which bounds its open files
+SORT_MERGE_FAN_IN = 64
+
+# Spill files the partitioned store hashes sessions into
+DEFAULT_PARTITIONS = 64
+
+# Rows pickled together in the spill files of disk-backed stores
+SPILL_BLOCK_SIZE = 4096
+
+# Bump whenever parsing, validation or grouping changes what a finalized store holds
+SNAPSHOT_VERSION = 6
+
+# Files picked up when a directory of daily shards is given as input
+DEFAULT_SHARD_PATTERN = '*.json*'
+
+# Leading bytes identifying each supported compression codec
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+}
+MAGIC_LENGTH = max(len(magic) for magic, _ in COMPRESSION_MAGIC)
+
+# Columnar file formats, read directly instead of as JSON Lines
+ARROW_FORMAT_MAGIC = [
+    (b'PAR1', 'parquet'),
+    (b'ARROW1', 'arrow'),
+]
+ARROW_FORMAT_EXTENSIONS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+
+# Columns the analysis reads, the only ones loaded from columnar inputs
+ANALYSIS_FIELDS = ('user_id', 'session_id', 'event_time', 'path', 'css', 'text')
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Split a stream of byte chunks into lines, keeping only one partial line in memory."""
+    pending = b''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = chunk.split(b'\n')
+        lines[0] = pending + lines[0]
+        pending = lines.pop()
+        yield from lines
+
+    if pending:
+        yield pending
+
+
+def iter_segment_lines(segments: Iterable[Tuple[int, bytes]]) -> Iterator[bytes]:
+    """Split (position, bytes) segments of a file arriving in any order into its lines.
+
+    Lines fully contained in a segment are yielded as soon as it arrives;
+    the few lines straddling segment boundaries are stitched back together,
+    in position order, once every segment is known.
+    """
+    # Per segment: text before its first newline, text after its last one,
+    # or the whole segment when a single line spans it entirely
+    heads = {}
+    tails = {}
+    for position, data in segments:
+        first = data.find(b'\n')
+        if first == -1:
+            heads[position] = data
+            continue
+
+        last = data.rfind(b'\n')
+        heads[position] = data[:first]
+        tails[position] = data[last + 1:]
+        if last > first:
+            yield from data[first + 1:last].split(b'\n')
+
+    # Stitch the lines that were cut at segment boundaries
+    carry = b''
+    for position in sorted(heads):
+        if position not in tails:
+            carry += heads[position]
+            continue
+        yield carry + heads[position]
+        carry = tails[position]
+    if carry:
+        yield carry
+
+
+def detect_compression(head: bytes, name: str = '') -> Optional[str]:
+    """Identify the codec of a stream from its magic bytes, falling back to the file extension."""
+    for magic, codec in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return codec
+
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+
+def _new_decompressor(codec: str):
+    """Create an incremental decompressor exposing decompress(), eof and unused_data."""
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'xz':
+        return lzma.LZMADecompressor()
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The 'zstandard' package is required to read zstd-compressed input")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def decompress_chunks(chunks: Iterable[bytes], codec: str) -> Iterator[bytes]:
+    """Decompress a stream of byte chunks on the fly, including multi-member files."""
+    decompressor = _new_decompressor(codec)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+
+            if decompressor.eof:
+                # Concatenated members (e.g. `cat a.gz b.gz`) each need a fresh decompressor
+                chunk = decompressor.unused_data
+                decompressor = _new_decompressor(codec)
+            else:
+                chunk = b''
+
+
+def _peek_compression(chunks: Iterator[bytes], name: str) -> Tuple[Optional[str], Iterator[bytes]]:
+    """Read enough leading bytes to detect the codec, returning it with the untouched stream."""
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= MAGIC_LENGTH:
+            break
+
+    return detect_compression(head, name), itertools.chain([head], chunks)
+
+
+class InputSource:
+    """A place JSON Lines events are read from, exposed as an iterator of raw lines.
+
+    Columnar sources (`columnar = True`) hold already typed events and are
+    read through iter_record_batches() instead.
+    """
+
+    description = 'input'
+    columnar = False
+
+    def fingerprint(self) -> Optional[str]:
+        """Identity of the current content, or None when it cannot be known without reading it all."""
+        return None
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    def iter_decompressed_chunks(self) -> Iterator[bytes]:
+        """Raw chunks, transparently decompressed when the stream turns out to be compressed."""
+        codec, chunks = _peek_compression(self.iter_chunks(), self.description)
+        if codec is not None:
+            chunks = decompress_chunks(chunks, codec)
+        return chunks
+
+    def iter_lines(self) -> Iterator[bytes]:
+        return iter_lines(self.iter_decompressed_chunks())
+
+
+class HttpSource(InputSource):
+    """JSON Lines file served over HTTP(S), streamed in chunks."""
+
+    def __init__(self, url: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.url = url
+        self.chunk_size = chunk_size
+        self.description = url
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        with requests.get(self.url, stream=True) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunk_size=self.chunk_size)
+
+
+class RangeHttpSource(HttpSource):
+    """JSON Lines file downloaded as concurrent byte ranges over a pooled HTTP session.
+
+    Lines fully contained in a segment are handed to parsing as soon as that
+    segment arrives, whatever its position; the few lines straddling segment
+    boundaries are stitched back together once their neighbours are known.
+    Compressed objects cannot be split this way, so their segments are still
+    fetched concurrently but decompressed in order, and so are all objects
+    with `in_order=True`, for readers that need the lines in file order.
+    Servers that do not honour range requests fall back to a plain streamed
+    GET.
+    """
+
+    def __init__(self, url: str, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 4,
+                 segment_size: int = DEFAULT_RANGE_SEGMENT_SIZE, in_order: bool = False):
+        super().__init__(url, chunk_size)
+        self.workers = workers
+        self.segment_size = segment_size
+        self.in_order = in_order
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        probe = self._probe()
+        if probe is None:
+            yield from super().iter_chunks()
+            return
 
-class UserFlowAnalyzer:
-    def __init__(self, data_url: str):
-        self.data_url = data_url
-        self.events = []
-        self.user_sessions = defaultdict(lambda: defaultdict(list))
-        self.flows = []
-        self.anomalies = []
+        size, _, validator = probe
+        for _, data in self.fetch_segments(size, validator, ordered=True):
+            yield data
 
-    def load_data(self) -> None:
-        """Load JSON Lines data from URL."""
-        print("Loading data from AWS...")
-        response = requests.get(self.data_url)
+    def iter_lines(self) -> Iterator[bytes]:
+        probe = self._probe()
+        if probe is None:
+            yield from super().iter_lines()
+            return
+
+        size, head, validator = probe
+        if not self.splittable(head):
+            yield from iter_lines(self.iter_decompressed_chunks())
+            return
+        yield from iter_segment_lines(self.fetch_segments(size, validator, ordered=False))
+
+    def splittable(self, head: bytes) -> bool:
+        """Whether lines can be cut from segments arriving out of order, given the leading bytes."""
+        return not self.in_order and detect_compression(head, self.url) is None
+
+    @staticmethod
+    def probe_headers() -> Dict[str, str]:
+        """Headers of the small range request that tells whether the server supports byte ranges."""
+        return {'Range': f'bytes=0-{MAGIC_LENGTH - 1}', 'Accept-Encoding': 'identity'}
+
+    @staticmethod
+    def range_size(response: requests.Response) -> Optional[int]:
+        """Object size announced by the answer to a range request, or None if the range was not honoured."""
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code != 206 or '/' not in content_range:
+            return None
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+
+    def _probe(self) -> Optional[Tuple[int, bytes, Optional[str]]]:
+        """Return (size, leading bytes, validator) if the server supports byte ranges."""
+        with self.session.get(self.url, headers=self.probe_headers(), stream=True) as response:
+            response.raise_for_status()
+            size = self.range_size(response)
+            if size is None:
+                return None
+
+            validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            return size, response.content, validator
+
+    def _fetch_range(self, start: int, end: int, validator: Optional[str]) -> bytes:
+        headers = {'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'}
+        if validator:
+            # Makes the server send the whole object instead if it changed since the probe
+            headers['If-Range'] = validator
+
+        response = self.session.get(self.url, headers=headers)
         response.raise_for_status()
+        if response.status_code != 206 or len(response.content) != end - start + 1:
+            raise RuntimeError(f"Range {start}-{end} of {self.url} changed or was not honoured by the server")
+        return response.content
+
+    def fetch_segments(self, size: int, validator: Optional[str], ordered: bool) -> Iterator[Tuple[int, bytes]]:
+        """Yield (index, bytes) per segment, keeping at most two segments per worker in flight."""
+        ranges = enumerate((start, min(start + self.segment_size, size) - 1)
+                           for start in range(0, size, self.segment_size))
+        max_in_flight = self.workers * 2
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = deque()
+
+            def submit(count: int) -> None:
+                for index, (start, end) in itertools.islice(ranges, count):
+                    in_flight.append((executor.submit(self._fetch_range, start, end, validator), index))
+
+            submit(max_in_flight)
+            while in_flight:
+                if ordered:
+                    future, index = in_flight.popleft()
+                    yield index, future.result()
+                    submit(1)
+                    continue
 
-        valid_events = 0
-        invalid_events = 0
+                done, _ = wait([future for future, _ in in_flight], return_when=FIRST_COMPLETED)
+                finished = [(future, index) for future, index in in_flight if future in done]
+                for item in finished:
+                    in_flight.remove(item)
+                submit(len(finished))
+                for future, index in finished:
+                    yield index, future.result()
+
+
+class LocalFileSource(InputSource):
+    """Regular file on local disk, read through mmap so lines are sliced straight from the page cache."""
+
+    def __init__(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.description = path
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def fingerprint(self) -> Optional[str]:
+        return file_fingerprint(self.path)
+
+    def compression(self) -> Optional[str]:
+        with open(self.path, 'rb') as f:
+            return detect_compression(f.read(MAGIC_LENGTH), self.path)
+
+    def iter_lines(self) -> Iterator[bytes]:
+        codec = self.compression()
+        if codec is not None:
+            # Compressed files cannot be sliced in place, stream them through the decompressor
+            yield from iter_lines(decompress_chunks(self.iter_chunks(), codec))
+            return
 
-        for line in response.text.strip().split('\n'):
-            if line.strip():
-                try:
-                    event = json.loads(line)
-                    # Validate required fields
-                    if self._is_valid_event(event):
-                        self.events.append(event)
-                        valid_events += 1
-                    else:
-                        invalid_events += 1
-                except json.JSONDecodeError:
-                    invalid_events += 1
+        yield from iter_file_range_lines(self.path, 0, os.path.getsize(self.path))
+
+    def byte_ranges(self, target_size: int) -> List[Tuple[int, int]]:
+        """Split the file into [start, end) ranges of about target_size bytes, each ending on a newline."""
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return []
+
+        boundaries = [0]
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                while boundaries[-1] + target_size < size:
+                    newline = mm.find(b'\n', boundaries[-1] + target_size)
+                    if newline == -1:
+                        break
+                    boundaries.append(newline + 1)
+
+        if boundaries[-1] < size:
+            boundaries.append(size)
+        return list(zip(boundaries, boundaries[1:]))
+
+
+def file_fingerprint(path: str) -> str:
+    """Path, size and modification time of a file, which change whenever it is rewritten."""
+    info = os.stat(path)
+    return f"{os.path.abspath(path)}:{info.st_size}:{info.st_mtime_ns}"
+
+
+def iter_file_range_lines(path: str, start: int, end: int) -> Iterator[bytes]:
+    """Slice the lines of an uncompressed file between two byte offsets out of an mmap."""
+    if start >= end:
+        # mmap refuses empty files
+        return
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+
+            while start < end:
+                newline = mm.find(b'\n', start, end)
+                if newline == -1:
+                    newline = end
+                yield mm[start:newline]
+                start = newline + 1
+
+
+class StreamSource(InputSource):
+    """Unseekable byte stream such as stdin or a named pipe, read in chunks."""
+
+    def __init__(self, stream: Union[str, BinaryIO], chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.description = stream if isinstance(stream, str) else getattr(stream, 'name', 'stream')
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        if isinstance(self.stream, str):
+            # Opening a FIFO blocks until a writer shows up, so defer it until iteration
+            with open(self.stream, 'rb') as f:
+                yield from self._read_chunks(f)
+        else:
+            yield from self._read_chunks(self.stream)
+
+    def _read_chunks(self, f: BinaryIO) -> Iterator[bytes]:
+        while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ShardedSource(InputSource):
+    """Several inputs (typically daily shards) read one after the other as a single stream."""
+
+    def __init__(self, sources: List[InputSource], description: str):
+        self.sources = sources
+        self.description = description
+        self.columnar = bool(sources) and all(source.columnar for source in sources)
+        if not self.columnar and any(source.columnar for source in sources):
+            raise ValueError(f"Cannot mix Parquet/Arrow and JSON Lines files in {description}")
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        for source in self.sources:
+            yield from source.iter_chunks()
+
+    def iter_lines(self) -> Iterator[bytes]:
+        # Shards are split independently so a file without a trailing newline
+        # does not get glued to the first line of the next one
+        for source in self.sources:
+            yield from source.iter_lines()
+
+    def iter_record_batches(self, columns: Tuple[str, ...] = ANALYSIS_FIELDS) -> Iterator['pyarrow.RecordBatch']:
+        for source in self.sources:
+            yield from source.iter_record_batches(columns)
+
+    def fingerprint(self) -> Optional[str]:
+        fingerprints = [source.fingerprint() for source in self.sources]
+        if None in fingerprints:
+            return None
+        return '|'.join(fingerprints)
+
+
+def detect_arrow_format(path: str) -> Optional[str]:
+    """'parquet' or 'arrow' for columnar files, from their magic bytes or extension, None otherwise."""
+    with open(path, 'rb') as f:
+        head = f.read(max(len(magic) for magic, _ in ARROW_FORMAT_MAGIC))
+    for magic, file_format in ARROW_FORMAT_MAGIC:
+        if head.startswith(magic):
+            return file_format
+
+    return ARROW_FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+class ArrowFileSource(InputSource):
+    """Parquet or Arrow IPC file of events, read as record batches of the requested columns only.
+
+    Parquet is column-oriented on disk, so the projection skips the bytes of
+    unread columns (`uuid`, `value`, ...) entirely. Arrow IPC files are
+    memory-mapped and projected without copying.
+    """
+
+    columnar = True
+
+    def __init__(self, path: str, file_format: str):
+        if pyarrow is None:
+            raise RuntimeError("The 'pyarrow' package is required to read Parquet and Arrow inputs")
+        self.path = path
+        self.file_format = file_format
+        self.description = path
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        raise ValueError(f"{self.path} is a {self.file_format} file, not JSON Lines")
+
+    def fingerprint(self) -> Optional[str]:
+        return file_fingerprint(self.path)
+
+    def iter_record_batches(self, columns: Tuple[str, ...] = ANALYSIS_FIELDS) -> Iterator['pyarrow.RecordBatch']:
+        if self.file_format == 'parquet':
+            parquet_file = pyarrow.parquet.ParquetFile(self.path)
+            present = [name for name in columns if name in parquet_file.schema_arrow.names]
+            yield from parquet_file.iter_batches(batch_size=INGEST_BATCH_SIZE, columns=present)
+            return
 
-        print(f"Loaded {valid_events} valid events")
-        if invalid_events > 0:
-            print(f"Skipped {invalid_events} invalid events")
+        with pyarrow.memory_map(self.path) as mapped:
+            try:
+                reader = pyarrow.ipc.open_file(mapped)
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            except pyarrow.ArrowInvalid:
+                # Arrow IPC stream format, which has no footer
+                mapped.seek(0)
+                batches = pyarrow.ipc.open_stream(mapped)
+
+            for batch in batches:
+                yield batch.select([name for name in columns if name in batch.schema.names])
+
+
+@contextlib.contextmanager
+def atomic_write(path: str) -> Iterator[BinaryIO]:
+    """Write a file through a temporary sibling that only replaces `path` if the block completes."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def evict_least_recently_used(directory: str, max_bytes: int, suffix: str, companions: Tuple[str, ...] = (),
+                              keep: Optional[str] = None) -> None:
+    """Delete the least recently used entries of a cache directory until they fit in max_bytes.
+
+    An entry is a file ending with `suffix`, whose mtime records its last
+    use, plus its namesakes ending with the `companions` suffixes. The entry
+    whose main file is `keep` (usually the one just written) is never deleted.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(directory, name)
+        paths = [path] + [path[:-len(suffix)] + companion for companion in companions]
+        try:
+            last_used = os.path.getmtime(path)
+            size = sum(os.path.getsize(entry_path) for entry_path in paths)
+        except OSError:
+            continue
+        entries.append((last_used, path, paths, size))
+        total += size
+
+    for _, path, paths, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        for entry_path in paths:
+            try:
+                os.unlink(entry_path)
+            except OSError:
+                pass
+        total -= size
 
-    def _is_valid_event(self, event: Dict) -> bool:
-        """Validate that an event has required fields."""
-        required_fields = ['user_id', 'session_id', 'event_time', 'path']
 
-        for field in required_fields:
-            if field not in event or event[field] is None:
-                return False
+class DownloadCache:
+    """On-disk cache of HTTP payloads, revalidated with their ETag / Last-Modified headers.
 
-        # Additional validation for event_time format
-        try:
-            datetime.fromisoformat(event['event_time'].replace('Z', '+00:00'))
-        except (ValueError, AttributeError):
-            return False
+    Each URL maps to a `<sha256>.body` payload and a `<sha256>.json` metadata
+    file. The metadata mtime records the last use, and the least recently used
+    entries are evicted once the cache grows past `max_bytes`.
+    """
 
-        return True
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
 
-    def process_events(self) -> None:
-        """Process events and group by user and session."""
-        print("Processing events...")
+    def _paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.body'), os.path.join(self.directory, key + '.json')
 
-        if not self.events:
-            print("No valid events to process")
+    def lookup(self, url: str) -> Optional[Dict]:
+        """Return the metadata of a cached payload, or None if there is no usable entry."""
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if os.path.getsize(body_path) != meta['size']:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+
+        meta['path'] = body_path
+        return meta
+
+    def touch(self, url: str) -> None:
+        """Mark an entry as recently used so eviction keeps it."""
+        os.utime(self._paths(url)[1])
+
+    def store(self, url: str, pieces: Iterable[Tuple[int, bytes]], etag: Optional[str],
+              last_modified: Optional[str]) -> Iterator[Tuple[int, bytes]]:
+        """Write (offset, bytes) pieces of a payload as they are passed through, in any order.
+
+        The entry and its validators are only committed, atomically, once the
+        last piece has been consumed; the generator then returns the payload
+        path. A download that fails or is abandoned leaves the cache as it was.
+        """
+        body_path, meta_path = self._paths(url)
+
+        size = 0
+        with atomic_write(body_path) as f:
+            for offset, data in pieces:
+                f.seek(offset)
+                f.write(data)
+                size += len(data)
+                yield offset, data
+
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': size,
+            'fetched_at': time.time(),
+        }
+        with atomic_write(meta_path) as f:
+            f.write(json.dumps(meta).encode('utf-8'))
+
+        self.evict(keep=meta_path)
+        return body_path
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        evict_least_recently_used(self.directory, self.max_bytes, '.json', ('.body',), keep)
+
+
+class CachedHttpSource(InputSource):
+    """HTTP source served from a DownloadCache, re-downloaded only when the object changed.
+
+    The first read of a run issues one conditional GET (If-None-Match /
+    If-Modified-Since), and later reads of the same run reuse its answer.
+    On a 304 the cached copy is read locally through mmap. On a miss the
+    body is parsed as it downloads, segments of a range-capable origin as
+    they arrive, while being written to the cache, which only keeps it once
+    it is complete. The stored validators always come from the response
+    that delivered the body, or that pinned it: with a range-capable origin
+    the conditional request is also the range probe, and the parallel
+    segments are tied to its validator with If-Range.
+    """
+
+    def __init__(self, origin: HttpSource, cache: DownloadCache):
+        self.origin = origin
+        self.cache = cache
+        self.description = f"{origin.url} (cached)"
+        self.cache_hit = None
+        # Cached payload, once it is known to be current
+        self.path = None
+        # ETag and Last-Modified of the payload read in this run
+        self.validators = None
+        # On a miss, what is needed to read the body: (streamed response or None, size of a
+        # range-capable origin or None, whether its segments can be parsed out of order)
+        self.pending = None
+
+    def _revalidate(self) -> None:
+        """Send the conditional request, leaving either `path` (hit) or the `pending` body (miss) to read."""
+        url = self.origin.url
+        meta = self.cache.lookup(url)
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        ranged = isinstance(self.origin, RangeHttpSource)
+        if ranged:
+            headers.update(RangeHttpSource.probe_headers())
+        get = self.origin.session.get if ranged else requests.get
+
+        response = get(url, headers=headers, stream=True)
+        if response.status_code == 304 and meta is not None:
+            response.close()
+            self.cache_hit = True
+            self.cache.touch(url)
+            self.path = meta['path']
+            self.validators = (meta.get('etag'), meta.get('last_modified'))
+            return
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+
+        self.cache_hit = False
+        self.validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        size = RangeHttpSource.range_size(response) if ranged else None
+        if size is not None:
+            # Only the probe range: the body comes from the parallel segments
+            self.pending = (None, size, self.origin.splittable(response.content))
+            response.close()
+        elif response.status_code == 206:
+            # A range answer without a usable size: the body is only part of the object. It is
+            # fetched again without validators, which would not describe that other response
+            response.close()
+            self.validators = (None, None)
+            self.pending = (None, None, False)
+        else:
+            # The server ignored the range (or none was asked for): this response is the whole body
+            self.pending = (response, None, False)
+
+    def _download(self, ordered: bool) -> Iterator[Tuple[int, bytes]]:
+        """(offset, bytes) pieces of the pending body, written to the cache as they are consumed."""
+        response, size, _ = self.pending
+        self.pending = None
+        origin = self.origin
+        etag, last_modified = self.validators
+
+        def response_pieces() -> Iterator[Tuple[int, bytes]]:
+            offset = 0
+            with response:
+                for chunk in response.iter_content(chunk_size=origin.chunk_size):
+                    yield offset, chunk
+                    offset += len(chunk)
+
+        def refetched_pieces() -> Iterator[Tuple[int, bytes]]:
+            offset = 0
+            for chunk in HttpSource.iter_chunks(origin):
+                yield offset, chunk
+                offset += len(chunk)
+
+        if size is not None:
+            # If-Range makes a segment fail if the object changed since the probe
+            segments = origin.fetch_segments(size, etag or last_modified, ordered=ordered)
+            pieces = ((index * origin.segment_size, data) for index, data in segments)
+        elif response is not None:
+            pieces = response_pieces()
+        else:
+            pieces = refetched_pieces()
+        self.path = yield from self.cache.store(origin.url, pieces, etag, last_modified)
+
+    def fingerprint(self) -> Optional[str]:
+        if self.path is None and self.pending is None:
+            self._revalidate()
+        # The validators identify the content whether it is cached already or still to be downloaded
+        if not any(self.validators):
+            return None
+        etag, last_modified = self.validators
+        return f"{self.origin.url}|{etag}|{last_modified}"
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        if self.path is None and self.pending is None:
+            self._revalidate()
+        if self.path is not None:
+            yield from LocalFileSource(self.path, self.origin.chunk_size).iter_chunks()
             return
+        for _, data in self._download(ordered=True):
+            yield data
+
+    def iter_lines(self) -> Iterator[bytes]:
+        if self.path is None and self.pending is None:
+            self._revalidate()
+        if self.path is not None:
+            yield from LocalFileSource(self.path, self.origin.chunk_size).iter_lines()
+        elif self.pending[2]:
+            yield from iter_segment_lines(self._download(ordered=False))
+        else:
+            yield from iter_lines(self.iter_decompressed_chunks())
+
+
+def open_source(spec: str, chunk_size: int = DEFAULT_CHUNK_SIZE, http_workers: int = 1,
+                cache: Optional[DownloadCache] = None, in_order: bool = False) -> InputSource:
+    """Build the input source matching a URL, file, directory, glob, FIFO or '-' for stdin.
+
+    `in_order` keeps the lines of concurrent HTTP downloads in file order.
+    """
+    if spec.startswith(('http://', 'https://')):
+        if http_workers > 1:
+            source = RangeHttpSource(spec, chunk_size, workers=http_workers, in_order=in_order)
+        else:
+            source = HttpSource(spec, chunk_size)
+        if cache is not None:
+            source = CachedHttpSource(source, cache)
+        return source
+
+    if spec == '-':
+        return StreamSource(sys.stdin.buffer, chunk_size)
+
+    if os.path.isdir(spec):
+        pattern = os.path.join(spec, DEFAULT_SHARD_PATTERN)
+    elif glob.has_magic(spec):
+        pattern = spec
+    else:
+        pattern = None
+
+    if pattern is not None:
+        paths = sorted(path for path in glob.glob(pattern) if not os.path.isdir(path))
+        if not paths:
+            raise FileNotFoundError(f"No input files match '{pattern}'")
+        return ShardedSource([open_source(path, chunk_size) for path in paths],
+                             f"{len(paths)} files matching {pattern}")
+
+    if stat.S_ISFIFO(os.stat(spec).st_mode):
+        return StreamSource(spec, chunk_size)
+
+    file_format = detect_arrow_format(spec)
+    if file_format is not None:
+        return ArrowFileSource(spec, file_format)
+
+    return LocalFileSource(spec, chunk_size)
+
+
+# Timestamps are normalized once at ingest to integer microseconds since the epoch (UTC)
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+MICROSECONDS_PER_SECOND = 1_000_000
+
+# Number of decoded lines whose timestamps are converted together during ingest
+INGEST_BATCH_SIZE = 4096
+
+# Bytes of input handed to each task of the multiprocess ingest
+DEFAULT_INGEST_RANGE_SIZE = 8 * 1024 * 1024
+
+# Fields of one sessions.json line, in the order decoders return them
+EVENT_FIELDS = ('uuid', 'user_id', 'session_id', 'event_time', 'path', 'css', 'text', 'value')
+
+# Fields an event is rejected without, and fields expected to hold strings
+REQUIRED_FIELDS = ('user_id', 'session_id', 'event_time', 'path')
+STRING_FIELDS = ('uuid', 'user_id', 'session_id', 'event_time', 'path', 'css', 'text')
+
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return 'MISSING'
+
+
+# Placeholder decoders return for keys absent from a line, as opposed to an explicit null.
+# msgspec's own UNSET is reused so its structs need no conversion.
+MISSING = msgspec.UNSET if msgspec is not None else _Missing()
+
+
+class Event:
+    """One validated event, stored in slots with its timestamp normalized once at ingest."""
+
+    __slots__ = EVENT_FIELDS + ('timestamp_us',)
+
+    def __init__(self, uuid: Optional[str], user_id: str, session_id: str, event_time: str, path: str,
+                 css: Optional[str], text: Optional[str], value: Any, timestamp_us: int):
+        self.uuid = uuid
+        self.user_id = user_id
+        self.session_id = session_id
+        self.event_time = event_time
+        self.path = path
+        self.css = css
+        self.text = text
+        self.value = value
+        self.timestamp_us = timestamp_us
+
+    def __repr__(self) -> str:
+        return f"Event({self.session_id!r}, {self.event_time!r}, {self.path!r})"
+
+    def __reduce__(self):
+        # Positional arguments instead of a per-object slot dict keep snapshots compact
+        return Event, tuple(getattr(self, field) for field in Event.__slots__)
+
+
+def parse_event_time(event_time: str) -> Optional[int]:
+    """Normalize an event_time string to epoch microseconds (UTC), or None if it is not a valid timestamp."""
+    try:
+        timestamp = datetime.fromisoformat(event_time.replace('Z', '+00:00'))
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+    if timestamp.tzinfo is not None:
+        # Naive timestamps are taken as UTC, aware ones are converted to it
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH) // ONE_MICROSECOND
+
+
+class TimestampParser:
+    """parse_event_time() with fast paths for the fixed `YYYY-MM-DD HH:MM:SS` layout.
+
+    Zone-less timestamps are converted with a single fromisoformat() call,
+    without the `Z` rewrite and time zone handling, and a repeat of the
+    previous string (common in time-ordered input) reuses its result.
+    parse_batch() converts whole batches at once with NumPy datetime64 when
+    every value is a 19-character string. Values the fast paths cannot
+    handle go through parse_event_time() and are counted in `fallbacks`.
+    """
+
+    def __init__(self):
+        self.fast = 0
+        self.fallbacks = 0
+        self._last_string = None
+        self._last_value = None
+
+    def __call__(self, event_time: Any) -> Optional[int]:
+        if event_time == self._last_string:
+            self.fast += 1
+            return self._last_value
+
+        try:
+            # Zone-aware results make the subtraction raise TypeError and take the generic path
+            value = (datetime.fromisoformat(event_time) - EPOCH) // ONE_MICROSECOND
+            self.fast += 1
+        except (ValueError, TypeError):
+            self.fallbacks += 1
+            value = parse_event_time(event_time)
+
+        self._last_string = event_time
+        self._last_value = value
+        return value
+
+    def parse_batch(self, event_times: List[Any]) -> List[Optional[int]]:
+        """Convert a batch of event_time values, vectorized when NumPy is installed."""
+        if (numpy is not None and event_times
+                and set(map(type, event_times)) == {str} and set(map(len, event_times)) == {19}):
+            with warnings.catch_warnings():
+                # NumPy only warns about zone offsets, leave those to parse_event_time()
+                warnings.simplefilter('error')
+                try:
+                    converted = numpy.array(event_times, dtype='datetime64[us]')
+                except (ValueError, Warning):
+                    converted = None
+
+            if converted is not None and not numpy.isnat(converted).any():
+                self.fast += len(event_times)
+                return converted.astype(numpy.int64).tolist()
+
+        return [self(event_time) for event_time in event_times]
+
+
+if msgspec is not None:
+    class SessionEventStruct(msgspec.Struct):
+        """Typed layout of one sessions.json line, decoded straight from bytes by msgspec."""
+        uuid: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        user_id: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        session_id: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        event_time: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        path: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        css: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        text: Union[Optional[str], msgspec.UnsetType] = msgspec.UNSET
+        value: Any = msgspec.UNSET
+
+
+class JsonDecoder:
+    """One JSON Lines decoding backend.
+
+    `decode` turns a line into a tuple of values in EVENT_FIELDS order
+    (MISSING for absent keys), or returns None when the line is valid JSON
+    but not an object. `errors` lists the exceptions it raises on malformed lines.
+    """
+
+    def __init__(self, name: str, decode: Callable[[bytes], Optional[tuple]], errors: Tuple[type, ...]):
+        self.name = name
+        self.decode = decode
+        self.errors = errors
+
+
+def _mapping_decode_function(loads: Callable[[bytes], Any]) -> Callable[[bytes], Optional[tuple]]:
+    string_field_count = len(STRING_FIELDS)
+
+    def decode(line: bytes) -> Optional[tuple]:
+        record = loads(line)
+        if not isinstance(record, dict):
+            return None
+        get = record.get
+        fields = (get('uuid', MISSING), get('user_id', MISSING), get('session_id', MISSING),
+                  get('event_time', MISSING), get('path', MISSING), get('css', MISSING),
+                  get('text', MISSING), get('value', MISSING))
+        # The msgspec struct's typing rule: string fields hold a string, null or nothing
+        for value in fields[:string_field_count]:
+            if value.__class__ is not str and value is not None and value is not MISSING:
+                raise ValueError(f"Field of type {type(value).__name__} where a string is expected")
+        return fields
+
+    return decode
+
+
+def _msgspec_decode_function() -> Callable[[bytes], tuple]:
+    decoder = msgspec.json.Decoder(SessionEventStruct)
+    astuple = msgspec.structs.astuple
+
+    def decode(line: bytes) -> tuple:
+        return astuple(decoder.decode(line))
+
+    return decode
+
+
+def available_json_backends() -> List[str]:
+    """Installed decoding backends, fastest first."""
+    backends = []
+    if msgspec is not None:
+        backends.append('msgspec')
+    if orjson is not None:
+        backends.append('orjson')
+    backends.append('json')
+    return backends
+
+
+def make_json_decoder(backend: str = 'auto') -> JsonDecoder:
+    """Return the requested decoding backend, or the fastest installed one for 'auto'."""
+    if backend == 'auto':
+        backend = available_json_backends()[0]
+    if backend not in available_json_backends():
+        raise ValueError(f"JSON backend '{backend}' is not available (installed: {', '.join(available_json_backends())})")
+
+    if backend == 'msgspec':
+        # Lines whose fields have the wrong type fail here as ValidationError, a DecodeError subclass
+        return JsonDecoder('msgspec', _msgspec_decode_function(), (msgspec.DecodeError,))
+    # Both mapping backends raise ValueError on fields of the wrong type. For orjson it also covers
+    # JSONDecodeError, and for json both JSONDecodeError and undecodable UTF-8
+    if backend == 'orjson':
+        return JsonDecoder('orjson', _mapping_decode_function(orjson.loads), (ValueError,))
+    return JsonDecoder('json', _mapping_decode_function(json.loads), (ValueError,))
+
+
+def benchmark_timestamp_parsers(event_times: List[str], repeat: int = 3) -> List[Tuple[str, float]]:
+    """Measure timestamp conversion throughput (values/s, best of `repeat`) of each parsing strategy."""
+    def generic() -> None:
+        for event_time in event_times:
+            parse_event_time(event_time)
+
+    def fast_path() -> None:
+        parser = TimestampParser()
+        for event_time in event_times:
+            parser(event_time)
+
+    def batched() -> None:
+        parser = TimestampParser()
+        for start in range(0, len(event_times), INGEST_BATCH_SIZE):
+            parser.parse_batch(event_times[start:start + INGEST_BATCH_SIZE])
+
+    strategies = [('generic', generic), ('fast path', fast_path)]
+    if numpy is not None:
+        strategies.append(('numpy batch', batched))
+
+    results = []
+    for name, run in strategies:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, len(event_times) / best if best else float('inf')))
+
+    return results
+
+
+def benchmark_json_decoders(lines: List[bytes], repeat: int = 3) -> List[Tuple[str, float]]:
+    """Measure per-line decoding throughput (lines/s, best of `repeat`) of every installed backend."""
+    results = []
+    for backend in available_json_backends():
+        decoder = make_json_decoder(backend)
+        decode = decoder.decode
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for line in lines:
+                try:
+                    decode(line)
+                except decoder.errors:
+                    pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((backend, len(lines) / best if best else float('inf')))
+
+    return results
+
+
+class StringDictionary:
+    """Dictionary encoding of a column: each distinct value is stored once and referenced by an integer code."""
+
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def encode(self, value: Any) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class EventStore:
+    """Holds validated events between ingest and analysis.
+
+    Events are fed one by one through add(), the store is finalized once
+    ingest is over, and analyzers then read time-ordered sessions from
+    iter_sessions() as (user_id, session_id, events) tuples. iter_sessions()
+    may be given the ANALYSIS_FIELDS the caller reads, letting stores that
+    rebuild Events skip the others (left None); user_id, session_id and
+    timestamp_us are always set. Stores whose data lives in temporary
+    files set `snapshottable` to False, and stores
+    that yield all the sessions of a user one after the other set
+    `sessions_grouped_by_user`, which deriving sessions per user relies on.
+    `streaming` stores hand each session to `on_session` during ingest
+    instead of keeping it for iter_sessions().
 
-        # Sort events by timestamp (now safe since we validated event_time)
-        self.events.sort(key=lambda x: x['event_time'])
+    Stores that keep events outside Python objects (columnar and on disk)
+    drop `uuid` and `value`, which no analysis reads. On-disk stores keep
+    their files in a temporary directory under their `directory` argument,
+    removed with the store. Stores that do not hold the input in memory
+    still keep the set of user ids for user_count, which grows with the
+    input; what the analyses keep of each session is up to them.
+    """
 
-        # Group by user_id and session_id
-        for event in self.events:
-            user_id = event['user_id']
-            session_id = event['session_id']
-            self.user_sessions[user_id][session_id].append(event)
+    snapshottable = True
+    sessions_grouped_by_user = True
+    streaming = False
 
-        print(f"Found {len(self.user_sessions)} unique users")
-        total_sessions = sum(len(sessions) for sessions in self.user_sessions.values())
-        print(f"Found {total_sessions} unique sessions")
+    def __init__(self):
+        self.event_count = 0
+        self.user_count = 0
+        self.session_count = 0
 
-    def analyze_flows(self) -> None:
-        """Analyze user flows and identify meaningful patterns."""
-        print("Analyzing user flows...")
+    def add(self, event: Event) -> None:
+        raise NotImplementedError
 
-        successful_checkouts = []
-        abandoned_flows = []
-        path_sequences = []
+    def finalize(self) -> None:
+        raise NotImplementedError
 
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
+        raise NotImplementedError
+
+
+def sort_session_events(events: List[Event]) -> None:
+    """Order a session's events by time in place, skipping the sort when they already are."""
+    timestamps = list(map(attrgetter('timestamp_us'), events))
+    if any(map(gt, timestamps, itertools.islice(timestamps, 1, None))):
+        # Stable, so events with the same timestamp keep their input order
+        events.sort(key=attrgetter('timestamp_us'))
+
+
+class InMemoryEventStore(EventStore):
+    """Every Event object kept in memory, nested by user and session as it arrives.
+
+    Grouping happens in add(), and finalize() only orders each session by
+    time: O(N log k) for sessions of k events instead of one global sort,
+    and sessions that arrived in order (the common case) are not sorted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.user_sessions = defaultdict(lambda: defaultdict(list))
+
+    def add(self, event: Event) -> None:
+        self.user_sessions[event.user_id][event.session_id].append(event)
+        self.event_count += 1
+
+    def finalize(self) -> None:
+        for sessions in self.user_sessions.values():
+            for events in sessions.values():
+                sort_session_events(events)
+
+        self.user_count = len(self.user_sessions)
+        self.session_count = sum(len(sessions) for sessions in self.user_sessions.values())
+
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
         for user_id, sessions in self.user_sessions.items():
             for session_id, events in sessions.items():
-                # Extract path sequence for this session
-                path_sequence = [event['path'] for event in events]
-                path_sequences.append(path_sequence)
-
-                # Check for successful checkout with improved detection
-                if self._is_successful_checkout(events):
-                    successful_checkouts.append({
-                        'user_id': user_id,
-                        'session_id': session_id,
-                        'path_sequence': path_sequence,
-                        'events': events
-                    })
-                else:
-                    abandoned_flows.append({
-                        'user_id': user_id,
-                        'session_id': session_id,
-                        'path_sequence': path_sequence,
-                        'last_path': path_sequence[-1] if path_sequence else None,
-                        'events': events
-                    })
+                yield user_id, session_id, events
 
-        # Analyze common flow patterns
-        self._analyze_flow_patterns(successful_checkouts, abandoned_flows, path_sequences)
+    def __getstate__(self) -> Dict:
+        # The nested defaultdicts are built from a lambda, which pickle refuses
+        state = self.__dict__.copy()
+        state['user_sessions'] = {user_id: dict(sessions) for user_id, sessions in self.user_sessions.items()}
+        return state
 
-        # Add product insights
-        self._analyze_product_insights()
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self.user_sessions = defaultdict(lambda: defaultdict(list))
+        for user_id, sessions in state['user_sessions'].items():
+            self.user_sessions[user_id].update(sessions)
+
+
+class ColumnarEventStore(EventStore):
+    """Events kept as typed arrays instead of objects.
+
+    Timestamps are int64 epoch microseconds. `path`, `css`, `text` and
+    `event_time` are dictionary-encoded, and so is each (user, session)
+    pair, whose user is itself a code into the user dictionary. After
+    finalize() rows are ordered by user, then session, then time, and
+    `session_offsets[i]:session_offsets[i + 1]` delimits the i-th session.
+    Event objects are only rebuilt one session at a time while iterating.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.users = StringDictionary()
+        self.sessions = StringDictionary()
+        self.paths = StringDictionary()
+        self.selectors = StringDictionary()
+        self.texts = StringDictionary()
+        self.event_times = StringDictionary()
+
+        self.timestamps = array('q')
+        self.session_codes = array('i')
+        self.path_codes = array('i')
+        self.css_codes = array('i')
+        self.text_codes = array('i')
+        self.event_time_codes = array('i')
+
+        self.session_offsets = array('q', [0])
+        self.session_order = array('i')
+
+    def add(self, event: Event) -> None:
+        self.timestamps.append(event.timestamp_us)
+        self.session_codes.append(self.sessions.encode((self.users.encode(event.user_id), event.session_id)))
+        self.path_codes.append(self.paths.encode(event.path))
+        self.css_codes.append(self.selectors.encode(event.css))
+        self.text_codes.append(self.texts.encode(event.text))
+        self.event_time_codes.append(self.event_times.encode(event.event_time))
+
+    def finalize(self) -> None:
+        row_count = len(self.timestamps)
+        session_count = len(self.sessions)
+
+        # Sessions grouped by user, each in order of first appearance
+        self.session_order = array('i', sorted(range(session_count), key=lambda code: self.sessions.values[code][0]))
+        rank = array('i', [0]) * session_count
+        for position, code in enumerate(self.session_order):
+            rank[code] = position
+
+        # Stable counting sort of the rows by session rank, O(N)
+        sizes = array('q', [0]) * session_count
+        for code in self.session_codes:
+            sizes[rank[code]] += 1
+        offsets = array('q', [0]) * (session_count + 1)
+        for position in range(session_count):
+            offsets[position + 1] = offsets[position] + sizes[position]
+
+        next_slot = offsets[:-1]
+        order = array('q', [0]) * row_count
+        for row, code in enumerate(self.session_codes):
+            position = rank[code]
+            order[next_slot[position]] = row
+            next_slot[position] += 1
+
+        # Order rows by time within each session, skipping sessions already in order
+        timestamps = self.timestamps
+        for position in range(session_count):
+            start, end = offsets[position], offsets[position + 1]
+            rows = order[start:end]
+            if any(timestamps[rows[i]] > timestamps[rows[i + 1]] for i in range(len(rows) - 1)):
+                order[start:end] = array('q', sorted(rows, key=timestamps.__getitem__))
+
+        for name in ('timestamps', 'path_codes', 'css_codes', 'text_codes', 'event_time_codes'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[row] for row in order]))
+        # Rows are now grouped, the per-row session codes are replaced by the offsets
+        self.session_codes = array('i')
+        self.session_offsets = offsets
+
+        self.event_count = row_count
+        self.user_count = len(self.users)
+        self.session_count = session_count
+
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
+        users = self.users.values
+        sessions = self.sessions.values
+        # (dictionary values, codes) of the event_time, path, css and text columns to decode
+        columns = [(dictionary.values, codes) if fields is None or name in fields else None
+                   for name, dictionary, codes in (('event_time', self.event_times, self.event_time_codes),
+                                                   ('path', self.paths, self.path_codes),
+                                                   ('css', self.selectors, self.css_codes),
+                                                   ('text', self.texts, self.text_codes))]
+
+        for position, code in enumerate(self.session_order):
+            user_code, session_id = sessions[code]
+            user_id = users[user_code]
+            start, end = self.session_offsets[position], self.session_offsets[position + 1]
+
+            decoded = [itertools.repeat(None) if column is None else map(column[0].__getitem__, column[1][start:end])
+                       for column in columns]
+            events = [
+                Event(None, user_id, session_id, event_time, path, css, text, None, timestamp_us)
+                for event_time, path, css, text, timestamp_us in zip(*decoded, self.timestamps[start:end])
+            ]
+            yield user_id, session_id, events
+
+
+def write_spill_rows(path: str, rows: Iterable[tuple]) -> None:
+    """Write row tuples to a spill file as a sequence of pickled blocks."""
+    with open(path, 'wb') as f:
+        for block in iter(lambda: list(itertools.islice(rows, SPILL_BLOCK_SIZE)), []):
+            pickle.dump(block, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_spill_rows(path: str) -> Iterator[tuple]:
+    """Stream back the rows of a spill file written by write_spill_rows()."""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block
+
+
+class ExternalSortEventStore(EventStore):
+    """Events sorted on disk, so the input never has to fit in memory.
+
+    add() buffers rows and writes every `run_size` of them as a sorted run
+    file. finalize() k-way merges the runs by (session_id, user_id, time),
+    at most SORT_MERGE_FAN_IN at a time, into one file that iter_sessions()
+    reads sequentially, holding a single session in memory. With
+    `group_by_user` the merge is by (user_id, session_id, time) instead, so
+    the sessions of a user come out together.
+    """
+
+    snapshottable = False
+
+    def __init__(self, run_size: int = DEFAULT_SORT_RUN_SIZE, directory: Optional[str] = None,
+                 group_by_user: bool = False):
+        super().__init__()
+        self.run_size = run_size
+        self.sessions_grouped_by_user = group_by_user
+        # Rows are (session_id, user_id, timestamp_us, event_time, path, css, text)
+        self.sort_key = itemgetter(1, 0, 2) if group_by_user else itemgetter(0, 1, 2)
+        self.directory = tempfile.mkdtemp(prefix='user_flow_sort_', dir=directory)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        self.buffer = []
+        self.runs = []
+        self.run_files = 0
+        self.sorted_path = None
+
+    def add(self, event: Event) -> None:
+        self.buffer.append((event.session_id, event.user_id, event.timestamp_us, event.event_time,
+                            event.path, event.css, event.text))
+        if len(self.buffer) >= self.run_size:
+            self._write_run(self.buffer)
+            self.buffer = []
+
+    def _new_run_path(self) -> str:
+        self.run_files += 1
+        return os.path.join(self.directory, f"run-{self.run_files:06d}")
+
+    def _write_run(self, rows: List[tuple]) -> None:
+        # list.sort is stable, so events with the same timestamp keep their input order
+        rows.sort(key=self.sort_key)
+        path = self._new_run_path()
+        write_spill_rows(path, iter(rows))
+        self.runs.append(path)
+
+    def _merge(self, paths: List[str], destination: str, rows_hook: Callable = None) -> None:
+        # heapq.merge takes ties from earlier runs first, which keeps the sort stable
+        merged = heapq.merge(*(read_spill_rows(path) for path in paths), key=self.sort_key)
+        write_spill_rows(destination, rows_hook(merged) if rows_hook else merged)
+        for path in paths:
+            os.unlink(path)
+
+    def finalize(self) -> None:
+        if self.buffer or not self.runs:
+            self._write_run(self.buffer)
+            self.buffer = []
+
+        # Intermediate passes until one merge can take every remaining run
+        while len(self.runs) > SORT_MERGE_FAN_IN:
+            runs = []
+            for start in range(0, len(self.runs), SORT_MERGE_FAN_IN):
+                path = self._new_run_path()
+                self._merge(self.runs[start:start + SORT_MERGE_FAN_IN], path)
+                runs.append(path)
+            self.runs = runs
+
+        users = set()
+        last_session = None
+
+        def count(rows: Iterator[tuple]) -> Iterator[tuple]:
+            nonlocal last_session
+            for row in rows:
+                self.event_count += 1
+                if row[:2] != last_session:
+                    last_session = row[:2]
+                    self.session_count += 1
+                    users.add(row[1])
+                yield row
+
+        self.sorted_path = os.path.join(self.directory, 'sorted')
+        self._merge(self.runs, self.sorted_path, count)
+        self.runs = []
+        self.user_count = len(users)
+
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
+        for (session_id, user_id), rows in itertools.groupby(read_spill_rows(self.sorted_path), key=itemgetter(0, 1)):
+            events = [Event(None, user_id, session_id, event_time, path, css, text, None, timestamp_us)
+                      for _, _, timestamp_us, event_time, path, css, text in rows]
+            yield user_id, session_id, events
+
+
+class PartitionedEventStore(EventStore):
+    """Events hash-partitioned by session_id into spill files, grouped one partition at a time.
+
+    add() appends each event to the spill file of its partition, so a
+    session always lands in a single partition. iter_sessions() then loads
+    the partitions one after the other, grouping and time-ordering the
+    sessions of the current partition only: memory holds about
+    1/`partitions` of the input. With `group_by_user` events are
+    partitioned by user_id instead, so all the sessions of a user share a
+    partition. Events and users are counted by add(), while the spill
+    files are only read by iter_sessions(): `session_count` stays None
+    until a first complete pass has counted the sessions partition by
+    partition (the analyzer makes one even when no analysis reads the
+    sessions).
+    """
+
+    snapshottable = False
+
+    def __init__(self, partitions: int = DEFAULT_PARTITIONS, directory: Optional[str] = None,
+                 group_by_user: bool = False):
+        super().__init__()
+        self.partitions = partitions
+        self.sessions_grouped_by_user = group_by_user
+        self.directory = tempfile.mkdtemp(prefix='user_flow_partitions_', dir=directory)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        self.paths = [os.path.join(self.directory, f"partition-{i:04d}") for i in range(partitions)]
+        self.files = None
+        self.buffers = [[] for _ in range(partitions)]
+        self.users = set()
+        self.session_count = None
+
+    def add(self, event: Event) -> None:
+        if self.files is None:
+            self.files = [open(path, 'wb') for path in self.paths]
+        self.event_count += 1
+        self.users.add(event.user_id)
+
+        # hash() is salted per process, which is fine: partitions only live as long as the store
+        partition = hash(event.user_id if self.sessions_grouped_by_user else event.session_id) % self.partitions
+        buffer = self.buffers[partition]
+        buffer.append((event.session_id, event.user_id, event.timestamp_us, event.event_time,
+                       event.path, event.css, event.text))
+        if len(buffer) >= SPILL_BLOCK_SIZE:
+            pickle.dump(buffer, self.files[partition], protocol=pickle.HIGHEST_PROTOCOL)
+            self.buffers[partition] = []
+
+    def finalize(self) -> None:
+        if self.files is None:
+            self.files = [open(path, 'wb') for path in self.paths]
+        for f, buffer in zip(self.files, self.buffers):
+            if buffer:
+                pickle.dump(buffer, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.close()
+        self.buffers = [[] for _ in range(self.partitions)]
+        self.user_count = len(self.users)
+
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
+        session_count = 0
+        for partition_path in self.paths:
+            # Nested by user so that the sessions of a user are yielded together
+            user_sessions = {}
+            for session_id, user_id, timestamp_us, event_time, path, css, text in read_spill_rows(partition_path):
+                sessions = user_sessions.get(user_id)
+                if sessions is None:
+                    sessions = user_sessions[user_id] = {}
+                events = sessions.get(session_id)
+                if events is None:
+                    events = sessions[session_id] = []
+                events.append(Event(None, user_id, session_id, event_time, path, css, text, None, timestamp_us))
+
+            for user_id, sessions in user_sessions.items():
+                session_count += len(sessions)
+                for session_id, events in sessions.items():
+                    sort_session_events(events)
+                    yield user_id, session_id, events
+        self.session_count = session_count
+
+
+# Inactivity after which a session ends, in seconds (used by Sessionizer and StreamingEventStore)
+DEFAULT_SESSION_TIMEOUT = 30 * 60
+
+# How far the watermark of the streaming store trails the newest event time, in seconds
+DEFAULT_ALLOWED_LATENESS = 5 * 60
+
+# What the streaming store does with a late event that has no open session to join
+LATE_EVENT_POLICIES = ('drop', 'separate')
+
+
+class StreamingEventStore(EventStore):
+    """Sessions analyzed and released as soon as the input has moved past them.
+
+    Meant for input roughly ordered by time. The watermark trails the
+    newest event time seen by `allowed_lateness` seconds, and a session is
+    closed once its last event is more than `timeout` seconds behind the
+    watermark: its events are time-ordered, handed to `on_session(user_id,
+    session_id, events)` (the analysis engine, set before ingest) and
+    dropped, so the events held follow the number of concurrently open
+    sessions rather than the size of the input. Events older than the watermark are
+    late: they still join their session while it is open. Closed sessions
+    are not remembered, so a late event without an open session - its
+    session has closed, or was never seen before the watermark passed it -
+    is dropped (`late_policy='drop'`) or starts a session of its own
+    ('separate'); both are counted in `late_events`. A session_id that
+    comes back in time after its session was closed starts a new session.
+    Nothing is kept for iter_sessions() or snapshots.
+    """
+
+    snapshottable = False
+    sessions_grouped_by_user = False
+    streaming = True
+
+    def __init__(self, timeout: float = DEFAULT_SESSION_TIMEOUT, allowed_lateness: float = DEFAULT_ALLOWED_LATENESS,
+                 late_policy: str = 'drop'):
+        if timeout <= 0:
+            raise ValueError(f"Session timeout must be positive, got {timeout}")
+        if allowed_lateness < 0:
+            raise ValueError(f"Allowed lateness cannot be negative, got {allowed_lateness}")
+        if late_policy not in LATE_EVENT_POLICIES:
+            raise ValueError(f"Unknown late event policy '{late_policy}' "
+                             f"(expected one of {', '.join(LATE_EVENT_POLICIES)})")
+        super().__init__()
+        self.timeout = timeout
+        self.allowed_lateness = allowed_lateness
+        self.late_policy = late_policy
+        self.timeout_us = int(timeout * MICROSECONDS_PER_SECOND)
+        self.lateness_us = int(allowed_lateness * MICROSECONDS_PER_SECOND)
+        self.on_session = None
+
+        # (user_id, session_id) -> [events, newest timestamp_us] of the open sessions
+        self.active = {}
+        # (deadline, sequence, key) of every open session; a deadline may be stale and is checked when popped
+        self.deadlines = []
+        self.sequence = 0
+        self.watermark = None
+        self.users = set()
+        self.late_events = 0
+        self.peak_active_sessions = 0
+
+    def add(self, event: Event) -> None:
+        timestamp_us = event.timestamp_us
+        key = (event.user_id, event.session_id)
+        session = self.active.get(key)
+
+        if session is not None:
+            session[0].append(event)
+            if timestamp_us > session[1]:
+                session[1] = timestamp_us
+        else:
+            if self.watermark is not None and timestamp_us < self.watermark:
+                self.late_events += 1
+                if self.late_policy == 'drop':
+                    return
+            self.active[key] = [[event], timestamp_us]
+            self._push_deadline(timestamp_us + self.timeout_us, key)
+            self.peak_active_sessions = max(self.peak_active_sessions, len(self.active))
+        self.event_count += 1
+
+        if self.watermark is None or timestamp_us - self.lateness_us > self.watermark:
+            self.watermark = timestamp_us - self.lateness_us
+            self._close_expired(self.watermark)
+
+    def _push_deadline(self, deadline: int, key: Tuple[str, str]) -> None:
+        # The sequence number breaks ties, so keys never have to be compared
+        heapq.heappush(self.deadlines, (deadline, self.sequence, key))
+        self.sequence += 1
+
+    def _close_expired(self, watermark: Optional[int]) -> None:
+        """Close the sessions whose deadline is behind the watermark (all of them for None), oldest first."""
+        deadlines = self.deadlines
+        while deadlines and (watermark is None or deadlines[0][0] < watermark):
+            _, _, key = heapq.heappop(deadlines)
+            events, newest = self.active[key]
+            deadline = newest + self.timeout_us
+            if watermark is not None and deadline >= watermark:
+                # The session got newer events since this deadline was pushed
+                self._push_deadline(deadline, key)
+                continue
 
-        # Add page activity insights
-        self._analyze_page_activity()
+            del self.active[key]
+            sort_session_events(events)
+            self.session_count += 1
+            self.users.add(key[0])
+            self.on_session(key[0], key[1], events)
+
+    def finalize(self) -> None:
+        self._close_expired(None)
+        self.user_count = len(self.users)
+
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
+        raise ValueError("A streaming store releases its sessions as they close, they cannot be read again")
+
+
+EVENT_STORES = {
+    'memory': InMemoryEventStore,
+    'columnar': ColumnarEventStore,
+    'external': ExternalSortEventStore,
+    'partitioned': PartitionedEventStore,
+    'streaming': StreamingEventStore,
+}
+
+
+def make_event_store(name: str, spill_dir: Optional[str] = None, sort_run_size: int = DEFAULT_SORT_RUN_SIZE,
+                     partitions: int = DEFAULT_PARTITIONS, group_by_user: bool = False,
+                     session_timeout: float = DEFAULT_SESSION_TIMEOUT,
+                     allowed_lateness: float = DEFAULT_ALLOWED_LATENESS, late_policy: str = 'drop') -> EventStore:
+    """Instantiate one of EVENT_STORES, passing the on-disk and streaming settings to the stores that use them.
+
+    `group_by_user` makes the disk-backed stores yield the sessions of a
+    user together (the in-memory ones always do), as derived sessions need.
+    """
+    if name == 'external':
+        return ExternalSortEventStore(sort_run_size, spill_dir, group_by_user)
+    if name == 'partitioned':
+        return PartitionedEventStore(partitions, spill_dir, group_by_user)
+    if name == 'streaming':
+        return StreamingEventStore(session_timeout, allowed_lateness, late_policy)
+    return EVENT_STORES[name]()
+
+
+SESSIONIZE_MODES = ('split', 'derive')
+
+
+class Sessionizer:
+    """Cuts sessions wherever a user stays inactive for longer than `timeout` seconds.
+
+    'split' keeps the sessions given by session_id but cuts each one at its
+    long gaps: the first piece keeps the original id and the next ones are
+    named '<session_id>#2', '<session_id>#3'... 'derive' ignores session_id
+    and cuts the time-ordered events of each user into '<user_id>#1',
+    '<user_id>#2'... In both modes the events keep their original
+    session_id, so every derived session can be traced back to its source.
+    """
+
+    def __init__(self, mode: str, timeout: float = DEFAULT_SESSION_TIMEOUT):
+        if mode not in SESSIONIZE_MODES:
+            raise ValueError(f"Unknown sessionization mode '{mode}' (expected one of {', '.join(SESSIONIZE_MODES)})")
+        if timeout <= 0:
+            raise ValueError(f"Session timeout must be positive, got {timeout}")
+        self.mode = mode
+        self.timeout = timeout
+        self.timeout_us = int(timeout * MICROSECONDS_PER_SECOND)
+
+    @property
+    def description(self) -> str:
+        return f"{self.mode} after {self.timeout / 60:g} min of inactivity"
+
+    def cut(self, events: List[Event]) -> Iterator[List[Event]]:
+        """Split time-ordered events at every gap longer than the timeout, in one pass."""
+        start = 0
+        timestamps = list(map(attrgetter('timestamp_us'), events))
+        for index in range(1, len(timestamps)):
+            if timestamps[index] - timestamps[index - 1] > self.timeout_us:
+                yield events[start:index]
+                start = index
+        # Sessions without a long gap, the common case, are passed through uncopied
+        yield events[start:] if start else events
+
+    def sessionize(self, sessions: Iterable[Tuple[str, str, List[Event]]]) -> Iterator[Tuple[str, str, List[Event]]]:
+        """Re-cut time-ordered sessions, streaming; 'derive' needs the sessions of a user to come together."""
+        if self.mode == 'split':
+            for user_id, session_id, events in sessions:
+                for number, piece in enumerate(self.cut(events), 1):
+                    yield user_id, session_id if number == 1 else f"{session_id}#{number}", piece
+            return
 
-    def _is_successful_checkout(self, events: List[Dict]) -> bool:
-        """Improved checkout detection with deduplication and content analysis."""
-        checkout_events = []
+        for user_id, user_sessions in itertools.groupby(sessions, key=itemgetter(0)):
+            events = [event for _, _, session_events in user_sessions for event in session_events]
+            # Already sorted when the sessions do not overlap, otherwise a merge of sorted runs
+            sort_session_events(events)
+            for number, piece in enumerate(self.cut(events), 1):
+                yield user_id, f"{user_id}#{number}", piece
+
+
+class SessionizedEventStore(EventStore):
+    """Another store whose sessions are re-cut by a Sessionizer as they are read.
+
+    Ingest goes straight to the wrapped store, which keeps its memory
+    profile and snapshot support; derived sessions are produced on the fly
+    by iter_sessions(), and finalize() counts them in one extra pass.
+    `original_session_count` keeps the number of sessions before the cut.
+    """
+
+    def __init__(self, store: EventStore, sessionizer: Sessionizer):
+        if store.streaming:
+            raise ValueError("Sessions of a streaming store are analyzed as they close and cannot be re-cut")
+        if sessionizer.mode == 'derive' and not store.sessions_grouped_by_user:
+            raise ValueError(f"{type(store).__name__} does not yield the sessions of a user together, "
+                             f"which deriving sessions needs")
+        super().__init__()
+        self.store = store
+        self.sessionizer = sessionizer
+        self.snapshottable = store.snapshottable
+        self.sessions_grouped_by_user = store.sessions_grouped_by_user
+        self.original_session_count = 0
+
+    def add(self, event: Event) -> None:
+        self.store.add(event)
+
+    def finalize(self) -> None:
+        self.store.finalize()
+        self.event_count = self.store.event_count
+        self.user_count = self.store.user_count
+        self.session_count = sum(1 for _ in self.iter_sessions(fields=()))
+        # Read after the pass, which is what counts the sessions of a partitioned store
+        self.original_session_count = self.store.session_count
+
+    def iter_sessions(self, fields: Optional[Tuple[str, ...]] = None) -> Iterator[Tuple[str, str, List[Event]]]:
+        return self.sessionizer.sessionize(self.store.iter_sessions(fields))
+
+
+class SnapshotCache:
+    """On-disk snapshots of finalized event stores, so re-runs skip ingest and grouping.
+
+    A snapshot is keyed by the input fingerprint, SNAPSHOT_VERSION and the
+    ingest settings that shape the store, and holds the pickled store with
+    the ingest counters. Changing an analysis threshold therefore reuses the
+    snapshot, while a new input, store type or ingest code does not. The
+    least recently used snapshots are evicted past `max_bytes`.
+    """
+
+    def __init__(self, directory: str = DEFAULT_SNAPSHOT_DIR, max_bytes: int = DEFAULT_SNAPSHOT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, fingerprint: str, config: Dict) -> str:
+        identity = json.dumps([SNAPSHOT_VERSION, fingerprint, config], sort_keys=True)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.snapshot')
+
+    def load(self, key: str) -> Optional[Tuple[EventStore, Dict]]:
+        """Return the (store, ingest stats) saved under a key, or None if there is no usable snapshot."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                store, stats = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+            return None
+        return store, stats
+
+    def save(self, key: str, store: EventStore, stats: Dict) -> str:
+        """Write a snapshot atomically, returning its path."""
+        path = self._path(key)
+        with atomic_write(path) as f:
+            pickle.dump((store, stats), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Delete least recently used snapshots until they fit in max_bytes."""
+        evict_least_recently_used(self.directory, self.max_bytes, '.snapshot', keep=keep)
+
+
+# Rows buffered before each record batch of the session table is written
+SESSION_TABLE_BATCH_SIZE = 64 * 1024
+
+
+def write_session_table(store: EventStore, path: str) -> int:
+    """Write the finalized sessions to Parquet (or Arrow IPC, by extension), returning the row count.
+
+    There is one row per event, grouped by user and session and time-ordered
+    within each session, with the position of the event in its session and
+    `event_time` as a UTC timestamp column. `original_session_id` is the
+    session_id of the input, which differs from `session_id` when sessions
+    were re-cut by a Sessionizer. The file can be fed back as input
+    or queried by any Arrow-aware tool.
+    """
+    if pyarrow is None:
+        raise RuntimeError("The 'pyarrow' package is required to write the session table")
+
+    schema = pyarrow.schema([
+        ('user_id', pyarrow.string()),
+        ('session_id', pyarrow.string()),
+        ('original_session_id', pyarrow.string()),
+        ('event_index', pyarrow.int32()),
+        ('event_time', pyarrow.timestamp('us', tz='UTC')),
+        ('path', pyarrow.string()),
+        ('css', pyarrow.string()),
+        ('text', pyarrow.string()),
+    ])
+    if ARROW_FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower()) == 'arrow':
+        writer = pyarrow.ipc.new_file(path, schema)
+    else:
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression='zstd')
+
+    columns = {name: [] for name in schema.names}
+    row_count = 0
+    with writer:
+        for user_id, session_id, events in store.iter_sessions():
+            user_id, session_id = str(user_id), str(session_id)
+            for index, event in enumerate(events):
+                columns['user_id'].append(user_id)
+                columns['session_id'].append(session_id)
+                columns['original_session_id'].append(str(event.session_id))
+                columns['event_index'].append(index)
+                columns['event_time'].append(event.timestamp_us)
+                columns['path'].append(event.path)
+                columns['css'].append(event.css)
+                columns['text'].append(event.text)
+
+            if len(columns['path']) >= SESSION_TABLE_BATCH_SIZE:
+                row_count += len(columns['path'])
+                writer.write_batch(pyarrow.RecordBatch.from_pydict(columns, schema=schema))
+                columns = {name: [] for name in schema.names}
+
+        if columns['path']:
+            row_count += len(columns['path'])
+            writer.write_batch(pyarrow.RecordBatch.from_pydict(columns, schema=schema))
+
+    return row_count
+
+
+# Kinds of field problems tracked by DataQuality
+FIELD_PROBLEMS = ('missing', 'null', 'malformed')
+
+
+class DataQuality:
+    """Data-quality counters of the ingest, in constant memory.
+
+    Every line gets its missing, null and malformed (wrong type, unparseable
+    `event_time`) values counted per field, whether or not it is kept.
+    Rejected lines are tallied by reason code: `invalid_json`, `not_object`,
+    or `<problem>:<field>` for each problem of a required field.
+    """
+
+    def __init__(self):
+        self.field_problems = {field: dict.fromkeys(FIELD_PROBLEMS, 0) for field in EVENT_FIELDS}
+        self.reasons = Counter()
+        self.rejected = 0
+
+    def count(self, field: str, problem: str, amount: int = 1) -> None:
+        self.field_problems[field][problem] += amount
+
+    def observe(self, fields: tuple) -> Tuple[tuple, List[str]]:
+        """Count the missing and null values of decoded fields.
+
+        Returns the fields with MISSING replaced by None, and the reason codes
+        that reject the line (empty if all required fields are present).
+        """
+        normalized = []
+        reasons = []
+        for field, value in zip(EVENT_FIELDS, fields):
+            if value is MISSING:
+                problem = 'missing'
+                value = None
+            elif value is None:
+                problem = 'null'
+            else:
+                normalized.append(value)
+                continue
 
-        # Find all checkout events in the session
-        for event in events:
-            if event['path'] == '/checkout':
-                checkout_events.append(event)
+            self.field_problems[field][problem] += 1
+            if field in REQUIRED_FIELDS:
+                reasons.append(f"{problem}:{field}")
+            normalized.append(value)
+        return tuple(normalized), reasons
 
-        if not checkout_events:
-            return False
+    def diagnose(self, line: bytes) -> List[str]:
+        """Count the problems of a line the decoder refused, returning its reason codes.
 
-        # Check each checkout event for success indicators
-        for checkout_event in checkout_events:
-            css = checkout_event.get('css', '').lower()
-            text = checkout_event.get('text', '').lower()
+        Only rejected lines get here, so the stdlib parser's slower but
+        complete view of the line is affordable.
+        """
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return ['invalid_json']
+        if not isinstance(record, dict):
+            return ['not_object']
+
+        reasons = []
+        for field in EVENT_FIELDS:
+            if field not in record:
+                problem = 'missing'
+            elif record[field] is None:
+                problem = 'null'
+            elif field in STRING_FIELDS and not isinstance(record[field], str):
+                problem = 'malformed'
+            else:
+                continue
 
-            # Check for failure indicators
-            if 'error' in css or 'error' in text:
+            self.field_problems[field][problem] += 1
+            if field in REQUIRED_FIELDS or problem == 'malformed':
+                reasons.append(f"{problem}:{field}")
+        # e.g. a construct one JSON library accepts and the other does not
+        return reasons or ['invalid_json']
+
+    def reject(self, reasons: List[str]) -> None:
+        self.rejected += 1
+        self.reasons.update(reasons)
+
+    def merge(self, other: 'DataQuality') -> None:
+        """Add the counters of another instance (e.g. from a worker process)."""
+        for field, problems in other.field_problems.items():
+            for problem, amount in problems.items():
+                self.field_problems[field][problem] += amount
+        self.reasons.update(other.reasons)
+        self.rejected += other.rejected
+
+
+class QuarantineWriter:
+    """Streams rejected input to a JSON Lines file with the reason codes of each rejection.
+
+    JSON lines are kept verbatim as `{"reasons": [...], "line": "..."}`,
+    rows of columnar inputs as `{"reasons": [...], "event": {...}}`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, record: Union[bytes, Dict], reasons: List[str]) -> None:
+        entry = {'reasons': reasons}
+        if isinstance(record, dict):
+            entry['event'] = record
+        else:
+            entry['line'] = bytes(record).decode('utf-8', 'replace')
+        self.file.write(json.dumps(entry, default=str) + '\n')
+        self.count += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class QuarantineBuffer:
+    """Rejections collected in a worker process, written to the QuarantineWriter by the parent."""
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record: Union[bytes, Dict], reasons: List[str]) -> None:
+        self.records.append((record if isinstance(record, dict) else bytes(record), reasons))
+
+
+class SessionSampler:
+    """Keeps a deterministic fraction of sessions, chosen by a hash of session_id.
+
+    The same session is kept or dropped in every run and on every worker,
+    and all its events go together, so sampled sessions are complete. With
+    `key='user_id'` whole users are sampled instead, which keeps complete
+    the sessions derived from a user's events by a Sessionizer.
+    """
+
+    def __init__(self, rate: float, key: str = 'session_id'):
+        if not 0 < rate <= 1:
+            raise ValueError(f"Sampling rate must be in (0, 1], got {rate}")
+        self.rate = rate
+        self.key = key
+        # Position of the key among the decoded fields
+        self.field_index = EVENT_FIELDS.index(key)
+        self.threshold = int(rate * 2 ** 64)
+        self._last_session = None
+        self._last_kept = False
+
+    def keep(self, session_id: Any) -> bool:
+        # Events of a session usually come in runs, reuse the previous decision
+        if session_id == self._last_session:
+            return self._last_kept
+        digest = hashlib.blake2b(str(session_id).encode('utf-8'), digest_size=8).digest()
+        self._last_session = session_id
+        self._last_kept = int.from_bytes(digest, 'little') < self.threshold
+        return self._last_kept
+
+
+# z-score of the two-sided 95% confidence intervals shown for sampled reports
+CONFIDENCE_Z = 1.96
+
+
+def estimate_total(sample_total: float, rate: float,
+                   sum_of_squares: Optional[float] = None) -> Tuple[float, float, float]:
+    """Scale a total measured on sampled sessions to the whole input, with a 95% confidence interval.
+
+    Sessions are kept independently with probability `rate`, so the
+    Horvitz-Thompson estimate is `sample_total / rate` with variance
+    `(1 - rate) / rate² · Σ xᵢ²` over the sampled sessions' values xᵢ.
+    `sum_of_squares` defaults to `sample_total`, i.e. one per counted session.
+    """
+    if sum_of_squares is None:
+        sum_of_squares = sample_total
+    estimate = sample_total / rate
+    margin = CONFIDENCE_Z * math.sqrt((1 - rate) * sum_of_squares) / rate
+    return estimate, max(0.0, estimate - margin), estimate + margin
+
+
+def wilson_interval(successes: int, trials: int) -> Tuple[float, float]:
+    """95% Wilson score interval of a proportion measured on sampled sessions."""
+    if not trials:
+        return 0.0, 0.0
+    share = successes / trials
+    z2 = CONFIDENCE_Z ** 2
+    center = (share + z2 / (2 * trials)) / (1 + z2 / trials)
+    margin = CONFIDENCE_Z * math.sqrt(share * (1 - share) / trials + z2 / (4 * trials ** 2)) / (1 + z2 / trials)
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class EventParser:
+    """Turns raw JSON Lines into validated Events.
+
+    Decoding, required-field validation and timestamp normalization all
+    happen here, so the in-process ingest and the worker processes of the
+    parallel ingest share the same rules and counters. Rejected lines are
+    counted in `quality` and, with a `quarantine`, written out with their
+    reason codes. With a `sampler`, valid events of sessions left out of the
+    sample are skipped before timestamp conversion and counted in
+    `sampled_out`; data-quality counters still cover every line.
+    """
+
+    def __init__(self, json_backend: str = 'auto',
+                 quarantine: Optional[Union[QuarantineWriter, QuarantineBuffer]] = None,
+                 sampler: Optional[SessionSampler] = None):
+        self.decoder = make_json_decoder(json_backend)
+        self.timestamp_parser = TimestampParser()
+        self.quality = DataQuality()
+        self.quarantine = quarantine
+        self.sampler = sampler
+        self.valid = 0
+        self.invalid = 0
+        self.sampled_out = 0
+
+    def counts(self) -> Tuple[int, int, int, int, int]:
+        return (self.valid, self.invalid, self.timestamp_parser.fast, self.timestamp_parser.fallbacks,
+                self.sampled_out)
+
+    def add_counts(self, counts: Tuple[int, int, int, int, int]) -> None:
+        """Accumulate the counters reported by another parser (e.g. in a worker process)."""
+        valid, invalid, fast, fallbacks, sampled_out = counts
+        self.valid += valid
+        self.invalid += invalid
+        self.timestamp_parser.fast += fast
+        self.timestamp_parser.fallbacks += fallbacks
+        self.sampled_out += sampled_out
+
+    def reject(self, record: Union[bytes, Dict], reasons: List[str]) -> None:
+        self.invalid += 1
+        self.quality.reject(reasons)
+        if self.quarantine is not None:
+            self.quarantine.write(record, reasons)
+
+    def parse(self, lines: Iterable[bytes]) -> Iterator[Event]:
+        """Decode and validate lines, yielding the valid events in input order."""
+        decode = self.decoder.decode
+        decode_errors = self.decoder.errors
+        observe = self.quality.observe
+        sampler = self.sampler
+
+        batch = []
+        batch_lines = []
+        for line in lines:
+            if not line or line.isspace():
                 continue
-            if 'cancel' in css or 'cancel' in text:
+            try:
+                fields = decode(line)
+            except decode_errors:
+                self.reject(line, self.quality.diagnose(line))
+                continue
+            if fields is None:
+                self.reject(line, ['not_object'])
                 continue
 
-            # Check for success indicator
-            if 'place order' in text:
-                return True
+            # Complete lines skip the per-field checks entirely
+            if None in fields or MISSING in fields:
+                fields, reasons = observe(fields)
+                if reasons:
+                    self.reject(line, reasons)
+                    continue
 
-        return False
+            if sampler is not None and not sampler.keep(fields[sampler.field_index]):
+                self.sampled_out += 1
+                continue
 
-    def _analyze_product_insights(self) -> None:
-        """Analyze most consulted products - count once per user session."""
-        product_sessions = Counter()
+            batch.append(fields)
+            batch_lines.append(line)
+            if len(batch) >= INGEST_BATCH_SIZE:
+                yield from self._make_events(batch, batch_lines)
+                batch = []
+                batch_lines = []
 
-        # Track unique product views per session
-        for user_id, sessions in self.user_sessions.items():
-            for session_id, events in sessions.items():
-                # Get unique products viewed in this session
-                products_in_session = set()
-                for event in events:
-                    path = event['path']
-                    # Look for product pages that start with /products/
-                    if path.startswith('/products/'):
-                        products_in_session.add(path)
+        yield from self._make_events(batch, batch_lines)
 
-                # Count each unique product once per session
-                for product in products_in_session:
-                    product_sessions[product] += 1
+    def parse_record_batches(self, batches: Iterable['pyarrow.RecordBatch']) -> Iterator[Event]:
+        """Validate Arrow record batches and yield their events, skipping JSON decoding entirely.
 
-        if product_sessions:
-            # Calculate total sessions that viewed products
-            total_product_sessions = sum(product_sessions.values())
+        `event_time` may be a string column, parsed like JSON values, or a
+        timestamp column, converted to epoch microseconds in one cast
+        (naive timestamps are taken as UTC, like naive strings).
+        """
+        for batch in batches:
+            names = batch.schema.names
+            missing = [name for name in REQUIRED_FIELDS if name not in names]
+            if missing:
+                raise ValueError(f"Columnar input lacks required column(s): {', '.join(missing)}")
+
+            for name in ('uuid',) + ANALYSIS_FIELDS:
+                if name in names:
+                    self.quality.count(name, 'null', batch.column(name).null_count)
+                elif name in ANALYSIS_FIELDS:
+                    self.quality.count(name, 'missing', batch.num_rows)
+
+            event_time = batch.column('event_time')
+            if pyarrow.types.is_timestamp(event_time.type):
+                # Unsafe so that nanosecond values are truncated to the microsecond instead of rejected
+                timestamps = event_time.cast(pyarrow.timestamp('us', tz=event_time.type.tz), safe=False)
+                timestamps = timestamps.cast(pyarrow.int64())
+                timestamps = timestamps.to_pylist()
+                self.timestamp_parser.fast += len(timestamps)
+                event_time = pyarrow.compute.strftime(event_time, format='%Y-%m-%d %H:%M:%S')
+            else:
+                timestamps = self.timestamp_parser.parse_batch(event_time.to_pylist())
+
+            # uuid is only part of the batch when a consumer (de-duplication) asked for it
+            columns = [batch.column(name).to_pylist() if name in names else itertools.repeat(None)
+                       for name in ('uuid', 'user_id', 'session_id', 'path', 'css', 'text')]
+            for uuid, user_id, session_id, event_time, path, css, text, timestamp_us in zip(
+                    columns[0], columns[1], columns[2], event_time.to_pylist(), columns[3], columns[4], columns[5],
+                    timestamps):
+                if user_id is None or session_id is None or path is None or timestamp_us is None:
+                    row = {'uuid': uuid, 'user_id': user_id, 'session_id': session_id, 'event_time': event_time,
+                           'path': path, 'css': css, 'text': text}
+                    reasons = [f"null:{field}" for field in REQUIRED_FIELDS if row[field] is None]
+                    if event_time is not None and timestamp_us is None:
+                        self.quality.count('event_time', 'malformed')
+                        reasons.append('malformed:event_time')
+                    self.reject(row, reasons)
+                    continue
+                if self.sampler is not None and not self.sampler.keep(
+                        user_id if self.sampler.key == 'user_id' else session_id):
+                    self.sampled_out += 1
+                    continue
+                self.valid += 1
+                yield Event(uuid, user_id, session_id, event_time, path, css, text, None, timestamp_us)
+
+    def _make_events(self, batch: List[tuple], lines: List[bytes]) -> Iterator[Event]:
+        """Timestamp normalization stage: build Events from a batch of decoded fields."""
+        # Invalid event_time formats come back as None and the event is dropped
+        timestamps = self.timestamp_parser.parse_batch([fields[3] for fields in batch])
+
+        for fields, line, timestamp_us in zip(batch, lines, timestamps):
+            if timestamp_us is None:
+                self.quality.count('event_time', 'malformed')
+                self.reject(line, ['malformed:event_time'])
+                continue
+            self.valid += 1
+            yield Event(*fields, timestamp_us)
 
-            self.flows.append({
-                'title': 'Most Consulted Products',
-                'description': f'Analysis of products viewed across {total_product_sessions} user sessions',
-                'details': {
-                    'total_product_sessions': total_product_sessions,
-                    'unique_products': len(product_sessions),
-                    'top_products': product_sessions.most_common(10)
-                }
-            })
 
-    def _analyze_page_activity(self) -> None:
-        """Analyze pages with longest user activity."""
-        page_durations = defaultdict(list)
+class Deduplicator:
+    """Drops events whose uuid was already seen earlier in the input; the first occurrence wins.
 
-        for user_id, sessions in self.user_sessions.items():
-            for session_id, events in sessions.items():
-                for i in range(len(events) - 1):
-                    try:
-                        current_time = datetime.fromisoformat(events[i]['event_time'].replace('Z', '+00:00'))
-                        next_time = datetime.fromisoformat(events[i + 1]['event_time'].replace('Z', '+00:00'))
-                        duration_seconds = (next_time - current_time).total_seconds()
-
-                        # Only count reasonable durations (less than 30 minutes)
-                        if 0 < duration_seconds < 1800:
-                            page_durations[events[i]['path']].append(duration_seconds)
-                    except (ValueError, AttributeError):
-                        continue
+    Events without a uuid are always kept.
+    """
 
-        # Calculate average duration per page
-        page_avg_durations = {}
-        for path, durations in page_durations.items():
-            if durations:
-                page_avg_durations[path] = statistics.mean(durations)
+    description = 'uuid'
 
-        if page_avg_durations:
-            # Sort by average duration
-            sorted_pages = sorted(page_avg_durations.items(), key=lambda x: x[1], reverse=True)
+    def __init__(self):
+        self.duplicates = 0
+
+    def seen(self, uuid: Any) -> bool:
+        """Record a uuid, returning whether it had been recorded before."""
+        raise NotImplementedError
+
+    def filter(self, events: Iterable[Event]) -> Iterator[Event]:
+        seen = self.seen
+        for event in events:
+            if event.uuid is not None and seen(event.uuid):
+                self.duplicates += 1
+                continue
+            yield event
 
-            self.flows.append({
-                'title': 'Pages with Longest Activity',
-                'description': f'Analysis of user time spent on {len(sorted_pages)} different pages',
-                'details': {
-                    'total_pages_analyzed': len(sorted_pages),
-                    'longest_activity_pages': [(path, f"{duration:.1f}s") for path, duration in sorted_pages[:10]],
-                    'average_page_time': f"{statistics.mean(page_avg_durations.values()):.1f}s"
-                }
-            })
 
-    def _analyze_flow_patterns(self, successful_checkouts: List[Dict],
-                              abandoned_flows: List[Dict],
-                              path_sequences: List[List[str]]) -> None:
+class ExactDeduplicator(Deduplicator):
+    """Every uuid kept in a set: no false positives, but memory grows with the number of events."""
+
+    description = 'exact uuid set'
+
+    def __init__(self):
+        super().__init__()
+        self.uuids = set()
+
+    def seen(self, uuid: Any) -> bool:
+        if uuid in self.uuids:
+            return True
+        self.uuids.add(uuid)
+        return False
+
+
+class BloomDeduplicator(Deduplicator):
+    """uuids recorded in a fixed-size Bloom filter sized for `capacity` events.
+
+    Memory is fixed up front (about 1.8 MB per million events at a 0.1%
+    error rate) whatever the input size. A false positive drops a unique
+    event as a duplicate with probability at most `error_rate` as long as
+    no more than `capacity` distinct uuids are seen; duplicates themselves
+    are never missed.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        super().__init__()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.description = f"Bloom filter, {error_rate:.2%} false positives up to {capacity:,} events"
+
+    def seen(self, uuid: Any) -> bool:
+        # Double hashing: the k probe positions are derived from one 128-bit digest
+        digest = hashlib.blake2b(str(uuid).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+
+        bits = self.bits
+        bit_count = self.bit_count
+        present = True
+        for i in range(self.hash_count):
+            position = (first + i * step) % bit_count
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                present = False
+                bits[position >> 3] |= mask
+        return present
+
+
+# Default sizing of the Bloom filter used by --dedup bloom
+DEFAULT_DEDUP_CAPACITY = 50_000_000
+DEFAULT_DEDUP_ERROR_RATE = 0.001
+
+
+def make_deduplicator(mode: str, capacity: int = DEFAULT_DEDUP_CAPACITY,
+                      error_rate: float = DEFAULT_DEDUP_ERROR_RATE) -> Optional[Deduplicator]:
+    """Deduplicator for a --dedup mode: 'off', 'exact' or 'bloom'."""
+    if mode == 'off':
+        return None
+    if mode == 'exact':
+        return ExactDeduplicator()
+    if mode == 'bloom':
+        return BloomDeduplicator(capacity, error_rate)
+    raise ValueError(f"Unknown de-duplication mode: {mode}")
+
+
+# Sessions shared across users that are named in the report
+SESSION_CONFLICT_EXAMPLES = 5
+
+
+class SessionOwnershipIndex:
+    """Checks at ingest that every session_id belongs to a single user_id.
+
+    The first user seen with a session owns it. Sessions and users are
+    kept as hash fingerprints in one dict of ints rather than as strings,
+    and every event is checked as it streams past, so there is no second
+    pass. Python's string hashes are only stable within a process, which is
+    all the index needs as it lives in the main process (after the parallel
+    workers are merged). Two sessions whose 64-bit fingerprints collide
+    could be reported as one shared session, which is vanishingly rare.
+
+    `conflicting_events` counts the events whose user is not the owner of
+    their session, and `shared` holds the user fingerprints of each shared
+    session. The other user ids of the first `max_examples` shared sessions
+    are kept for the report.
+    """
+
+    def __init__(self, max_examples: int = SESSION_CONFLICT_EXAMPLES):
+        self.max_examples = max_examples
+        self.owners = {}
+        self.shared = {}
+        self.conflicting_events = 0
+        # session_id -> up to max_examples user ids seen with it besides its owner, for the first shared sessions
+        self.examples = {}
+
+    def filter(self, events: Iterable[Event]) -> Iterator[Event]:
+        owners = self.owners
+        for event in events:
+            user = hash(event.user_id)
+            owner = owners.setdefault(hash(event.session_id), user)
+            if owner != user:
+                self._record_conflict(event, owner, user)
+            yield event
+
+    def _record_conflict(self, event: Event, owner: int, user: int) -> None:
+        self.conflicting_events += 1
+        session = hash(event.session_id)
+        users = self.shared.get(session)
+        if users is None:
+            users = self.shared[session] = {owner}
+            if len(self.examples) < self.max_examples:
+                self.examples[event.session_id] = []
+        if user not in users:
+            users.add(user)
+            other_users = self.examples.get(event.session_id)
+            if other_users is not None and len(other_users) < self.max_examples:
+                other_users.append(event.user_id)
+
+    def counts(self) -> Dict:
+        """What the report shows, without the fingerprints."""
+        return {
+            'shared_sessions': len(self.shared),
+            'conflicting_events': self.conflicting_events,
+            'examples': [{'session_id': session_id,
+                          'user_count': len(self.shared[hash(session_id)]),
+                          'other_user_ids': other_users}
+                         for session_id, other_users in self.examples.items()],
+        }
+
+
+# Parser of the current ingest worker process, created by _init_ingest_worker()
+_worker_parser = None
+
+
+def _init_ingest_worker(json_backend: str, quarantine: bool, sampler: Optional[SessionSampler]) -> None:
+    global _worker_parser
+    _worker_parser = EventParser(json_backend, QuarantineBuffer() if quarantine else None, sampler)
+
+
+def _events_to_columns(events: Iterable[Event]) -> Tuple[Tuple[list, ...], array]:
+    """Pack events into one list per field plus an int64 timestamp array.
+
+    Repeated strings are interned so that pickle sends each distinct value
+    of a batch once and refers back to it afterwards.
+    """
+    columns = tuple([] for _ in EVENT_FIELDS)
+    appends = [column.append for column in columns]
+    timestamps = array('q')
+    interned = {}
+    intern = interned.setdefault
+
+    for event in events:
+        appends[0](event.uuid)
+        for append, field in zip(appends[1:7], (event.user_id, event.session_id, event.event_time,
+                                               event.path, event.css, event.text)):
+            append(intern(field, field) if field.__class__ is str else field)
+        appends[7](event.value)
+        timestamps.append(event.timestamp_us)
+
+    return columns, timestamps
+
+
+def _parse_in_worker(lines: Iterable[bytes]):
+    # Quality counters and quarantined lines are reported per task, then started afresh
+    _worker_parser.quality = DataQuality()
+    if _worker_parser.quarantine is not None:
+        _worker_parser.quarantine = QuarantineBuffer()
+
+    before = _worker_parser.counts()
+    columns, timestamps = _events_to_columns(_worker_parser.parse(lines))
+    after = _worker_parser.counts()
+    counts = tuple(b - a for a, b in zip(before, after))
+    rejected = _worker_parser.quarantine.records if _worker_parser.quarantine is not None else []
+    return columns, timestamps, counts, _worker_parser.quality, rejected
+
+
+def _parse_file_range_task(path: str, start: int, end: int):
+    return _parse_in_worker(iter_file_range_lines(path, start, end))
+
+
+def _parse_block_task(block: bytes):
+    return _parse_in_worker(block.split(b'\n'))
+
+
+def _local_uncompressed_files(source: InputSource) -> Optional[List[LocalFileSource]]:
+    """The files behind a source if workers can read them directly, None otherwise."""
+    if isinstance(source, LocalFileSource):
+        return [source] if source.compression() is None else None
+    if isinstance(source, ShardedSource):
+        files = []
+        for shard in source.sources:
+            shard_files = _local_uncompressed_files(shard)
+            if shard_files is None:
+                return None
+            files.extend(shard_files)
+        return files
+    return None
+
+
+def _iter_line_blocks(lines: Iterable[bytes], target_size: int) -> Iterator[bytes]:
+    """Group lines into newline-joined blocks of about target_size bytes."""
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line) + 1
+        if size >= target_size:
+            yield b'\n'.join(block)
+            block = []
+            size = 0
+    if block:
+        yield b'\n'.join(block)
+
+
+def parse_events_parallel(source: InputSource, parser: EventParser, workers: int,
+                          range_size: int = DEFAULT_INGEST_RANGE_SIZE) -> Iterator[Event]:
+    """Parse and validate a source in a process pool, yielding events in input order.
+
+    Uncompressed local files are split into newline-aligned byte ranges that
+    each worker reads through its own mmap. Other sources are read (and
+    decompressed) here and shipped to workers as blocks of lines. Workers
+    send back column batches rather than Event objects, which keeps the
+    pickled payload small, and their counters and rejected lines are merged
+    into `parser`.
+    """
+    files = _local_uncompressed_files(source)
+    if files is not None:
+        tasks = ((_parse_file_range_task, (file.path, start, end))
+                 for file in files for start, end in file.byte_ranges(range_size))
+    else:
+        tasks = ((_parse_block_task, (block,)) for block in _iter_line_blocks(source.iter_lines(), range_size))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_ingest_worker,
+                             initargs=(parser.decoder.name, parser.quarantine is not None,
+                                       parser.sampler)) as executor:
+        # Bounded window of in-flight tasks, consumed in submission order
+        in_flight = deque()
+        for function, args in itertools.islice(tasks, workers * 2):
+            in_flight.append(executor.submit(function, *args))
+
+        while in_flight:
+            columns, timestamps, counts, quality, rejected = in_flight.popleft().result()
+            for function, args in itertools.islice(tasks, 1):
+                in_flight.append(executor.submit(function, *args))
+
+            parser.add_counts(counts)
+            parser.quality.merge(quality)
+            for record, reasons in rejected:
+                parser.quarantine.write(record, reasons)
+            for row in zip(*columns, timestamps):
+                yield Event(*row)
+
+
+# Keywords in an event's css or text that mark it as an error
+ERROR_KEYWORDS = ('error', '404', 'timeout', 'failed', 'invalid', 'missing')
+
+# SessionSummary.outcome values
+OUTCOME_CONVERTED = 'converted'
+OUTCOME_ABANDONED = 'abandoned'
+
+# Event fields read to summarize a session
+SUMMARY_FIELDS = ('path', 'css', 'text')
+
+
+class SessionSummary:
+    """What flow analytics keep of a session once its events are released.
+
+    Times are epoch microseconds and `outcome` is OUTCOME_CONVERTED or
+    OUTCOME_ABANDONED. `path_sequence`, the tuple of visited paths, is only
+    set for converted sessions (None otherwise): abandoned paths are too
+    varied to be worth keeping, and analyses that keep a path must not grow
+    with every session seen. `sample_unit` is the analyzer's sample_unit()
+    of the session's events, for the CIs of scaled session counts.
+    """
+
+    __slots__ = ('user_id', 'session_id', 'sample_unit', 'entry_page', 'exit_page', 'path_sequence', 'start_us',
+                 'end_us', 'event_count', 'outcome')
+
+    def __init__(self, user_id: str, session_id: str, sample_unit: str, entry_page: str, exit_page: str,
+                 path_sequence: Optional[Tuple[str, ...]], start_us: int, end_us: int, event_count: int,
+                 outcome: str):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.sample_unit = sample_unit
+        self.entry_page = entry_page
+        self.exit_page = exit_page
+        self.path_sequence = path_sequence
+        self.start_us = start_us
+        self.end_us = end_us
+        self.event_count = event_count
+        self.outcome = outcome
+
+    def __repr__(self) -> str:
+        return f"SessionSummary({self.session_id!r}, {self.event_count} events, {self.outcome!r})"
+
+    @property
+    def duration_minutes(self) -> float:
+        return (self.end_us - self.start_us) / MICROSECONDS_PER_SECOND / 60
+
+
+# What an analysis plugin is fed: whole sessions, their summaries, single events or pairs of consecutive events
+ANALYSIS_SCOPES = ('session', 'summary', 'event', 'transition')
+
+
+class AnalysisPlugin:
+    """A flow analysis or anomaly detector run by UserFlowAnalyzer.analyze_sessions().
+
+    Plugins declare what they consume and the engine does the reading:
+
+    - `scope`: 'session' plugins get visit_session(user_id, session_id,
+      events) once per time-ordered session, 'summary' plugins get
+      visit_summary(summary) with the SessionSummary the engine builds once
+      per session, 'event' plugins get visit_event(user_id, session_id,
+      event) for each event, and 'transition' plugins get
+      visit_transition(user_id, session_id, previous, current) for each
+      pair of consecutive events in a session.
+    - `fields`: the ANALYSIS_FIELDS read besides user_id, session_id and
+      timestamp_us, which are always set. Stores only have to materialize
+      the fields some plugin of the pass asked for; the others may be None.
+    - `requires`: names of plugins whose finish() must have run before this
+      one starts, when it builds on their results (see analyzer.analyses).
+
+    Every plugin of a pass is fed from a single read of the store, and a
+    plugin only goes to a later pass when it requires one, so the engine
+    reads the sessions as many times as the longest chain of requirements.
+    finish() runs right after the plugin's pass and appends its results to
+    the analyzer's `flows` or `anomalies`. Plugins are registered with
+    @register_analysis and run in registration order.
+    """
+
+    name = None
+    scope = 'session'
+    fields = ANALYSIS_FIELDS
+    requires = ()
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        self.analyzer = analyzer
+
+    def visit_session(self, user_id: str, session_id: str, events: List[Event]) -> None:
+        raise NotImplementedError
+
+    def visit_summary(self, summary: SessionSummary) -> None:
+        raise NotImplementedError
+
+    def visit_event(self, user_id: str, session_id: str, event: Event) -> None:
+        raise NotImplementedError
+
+    def visit_transition(self, user_id: str, session_id: str, previous: Event, current: Event) -> None:
+        raise NotImplementedError
+
+    def finish(self) -> None:
+        raise NotImplementedError
+
+
+# Registered analysis plugins by name, in the order their results are reported
+ANALYSIS_PLUGINS = {}
+
+
+def register_analysis(plugin: type) -> type:
+    """Class decorator adding an AnalysisPlugin subclass to ANALYSIS_PLUGINS."""
+    if not plugin.name:
+        raise ValueError(f"Analysis plugin {plugin.__name__} has no name")
+    if plugin.scope not in ANALYSIS_SCOPES:
+        raise ValueError(f"Analysis plugin '{plugin.name}' has unknown scope '{plugin.scope}' "
+                         f"(expected one of {', '.join(ANALYSIS_SCOPES)})")
+    unknown = [field for field in plugin.fields if field not in ANALYSIS_FIELDS]
+    if unknown:
+        raise ValueError(f"Analysis plugin '{plugin.name}' reads unknown field(s): {', '.join(unknown)}")
+    if getattr(plugin, 'visit_' + plugin.scope) is getattr(AnalysisPlugin, 'visit_' + plugin.scope):
+        raise ValueError(f"Analysis plugin '{plugin.name}' does not implement visit_{plugin.scope}()")
+    ANALYSIS_PLUGINS[plugin.name] = plugin
+    return plugin
+
+
+def import_plugin(spec: str) -> None:
+    """Import a module registering analysis plugins, given by module name or by .py file path.
+
+    Module names are also looked up in the working directory, which is not
+    on sys.path when this script is run by path.
+    """
+    if spec.endswith('.py'):
+        name = os.path.splitext(os.path.basename(spec))[0]
+        module_spec = importlib.util.spec_from_file_location(name, spec)
+        module = importlib.util.module_from_spec(module_spec)
+        sys.modules[name] = module
+        module_spec.loader.exec_module(module)
+        return
+
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    importlib.import_module(spec)
+
+
+def schedule_analyses(plugins: List[AnalysisPlugin]) -> List[List[AnalysisPlugin]]:
+    """Group plugins into the fewest passes that still run each one after the plugins it requires.
+
+    A plugin goes to the pass right after the last of its requirements (the
+    first pass if it has none), keeping registration order within a pass.
+    """
+    by_name = {plugin.name: plugin for plugin in plugins}
+    levels = {}
+
+    def level(plugin: AnalysisPlugin, chain: Tuple[str, ...] = ()) -> int:
+        if plugin.name in chain:
+            raise ValueError(f"Analysis plugins require each other: {' -> '.join(chain + (plugin.name,))}")
+        if plugin.name not in levels:
+            for name in plugin.requires:
+                if name not in by_name:
+                    raise ValueError(f"Analysis '{plugin.name}' requires '{name}', which is not enabled")
+            levels[plugin.name] = 1 + max((level(by_name[name], chain + (plugin.name,)) for name in plugin.requires),
+                                          default=-1)
+        return levels[plugin.name]
+
+    passes = []
+    for plugin in plugins:
+        index = level(plugin)
+        while len(passes) <= index:
+            passes.append([])
+        passes[index].append(plugin)
+    return passes
+
+
+class SampleUnitCounter:
+    """Counts per key, with the per-sampled-unit squares that the CI of a scaled event count needs.
+
+    Events of one sampled unit (a session_id, or a user_id when sampling
+    users) arrive one after the other, as for SampleUnitSizes, so the
+    counts of a unit are squared and dropped as soon as the next unit
+    starts, and only one running count per key is kept. Counts of sessions
+    are kept the same way, with the sessions of a unit as its events. The
+    None key is used for the total by the analyses that need one.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.squares = Counter()
+        self.unit = None
+        self.unit_counts = Counter()
+
+    def add(self, unit: Any, *keys: Any) -> None:
+        if unit != self.unit:
+            self._close_unit()
+            self.unit = unit
+        for key in keys:
+            self.unit_counts[key] += 1
+            self.counts[key] += 1
+
+    def _close_unit(self) -> None:
+        for key, count in self.unit_counts.items():
+            self.squares[key] += count * count
+        self.unit_counts.clear()
+
+    def finish(self) -> None:
+        self._close_unit()
+
+
+# Examples of a finding kept for the report
+MAX_EXAMPLES = 5
+
+
+@register_analysis
+class FlowPatternAnalysis(AnalysisPlugin):
+    """Successful purchase flows, abandonment points and entry points.
+
+    Summaries are folded into counters as they come, keyed by outcome,
+    converted path sequence, exit page and entry page, so nothing is kept
+    per session. Several sessions of one sampled unit widen the CIs of
+    these counts, hence SampleUnitCounter.
+    """
+
+    name = 'flow_patterns'
+    scope = 'summary'
+    fields = ()
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        self.outcomes = SampleUnitCounter()
+        self.successful_paths = SampleUnitCounter()
+        self.abandonment_points = SampleUnitCounter()
+        self.entry_points = SampleUnitCounter()
+
+    def visit_summary(self, summary: SessionSummary) -> None:
+        unit = summary.sample_unit
+        self.outcomes.add(unit, summary.outcome)
+        if summary.outcome == OUTCOME_CONVERTED:
+            self.successful_paths.add(unit, summary.path_sequence)
+        elif summary.exit_page:
+            self.abandonment_points.add(unit, summary.exit_page)
+        self.entry_points.add(unit, summary.entry_page)
+
+    def finish(self) -> None:
         """Analyze and categorize flow patterns."""
+        analyzer = self.analyzer
+        outcomes = self.outcomes
+        for counter in (outcomes, self.successful_paths, self.abandonment_points, self.entry_points):
+            counter.finish()
+        session_count = sum(outcomes.counts.values())
+        successful_count = outcomes.counts[OUTCOME_CONVERTED]
+        abandoned_count = outcomes.counts[OUTCOME_ABANDONED]
 
         # Most common successful flow
-        if successful_checkouts:
-            successful_paths = [' → '.join(flow['path_sequence']) for flow in successful_checkouts]
-            most_common_success = Counter(successful_paths).most_common(3)
+        if successful_count:
+            total_successful = analyzer.scaled(successful_count, outcomes.squares[OUTCOME_CONVERTED])
+            most_common_success = [(' → '.join(path_sequence), count)
+                                   for path_sequence, count in analyzer.scaled_most_common(self.successful_paths, 3)]
 
-            self.flows.append({
+            analyzer.flows.append({
                 'title': 'Successful Purchase Flows',
-                'description': f'Found {len(successful_checkouts)} successful checkout sessions',
+                'description': f'Found {total_successful} successful checkout sessions',
                 'details': {
-                    'total_successful': len(successful_checkouts),
+                    'total_successful': total_successful,
                     'most_common_patterns': most_common_success,
-                    'conversion_rate': f"{len(successful_checkouts) / len(path_sequences) * 100:.1f}%"
+                    'conversion_rate': analyzer.share(successful_count, session_count)
                 }
             })
 
         # Abandonment analysis
-        if abandoned_flows:
-            abandonment_points = Counter([flow['last_path'] for flow in abandoned_flows if flow['last_path']])
-
-            self.flows.append({
+        if abandoned_count:
+            total_abandoned = analyzer.scaled(abandoned_count, outcomes.squares[OUTCOME_ABANDONED])
+            analyzer.flows.append({
                 'title': 'Flow Abandonment Patterns',
-                'description': f'Analyzed {len(abandoned_flows)} abandoned sessions',
+                'description': f'Analyzed {total_abandoned} abandoned sessions',
                 'details': {
-                    'total_abandoned': len(abandoned_flows),
-                    'common_exit_points': abandonment_points.most_common(5),
-                    'abandonment_rate': f"{len(abandoned_flows) / len(path_sequences) * 100:.1f}%"
+                    'total_abandoned': total_abandoned,
+                    'common_exit_points': analyzer.scaled_most_common(self.abandonment_points, 5),
+                    'abandonment_rate': analyzer.share(abandoned_count, session_count)
                 }
             })
 
         # Common entry points
-        entry_points = Counter([seq[0] for seq in path_sequences if seq])
-        self.flows.append({
+        analyzer.flows.append({
             'title': 'User Entry Points',
             'description': 'Most common starting pages for user sessions',
             'details': {
-                'top_entry_points': entry_points.most_common(5)
+                'top_entry_points': analyzer.scaled_most_common(self.entry_points, 5)
             }
         })
 
-    def detect_anomalies(self) -> None:
-        """Detect anomalies in user behavior and technical issues."""
-        print("Detecting anomalies...")
 
-        self._detect_time_gaps()
-        self._detect_error_patterns()
-        self._detect_unusual_behaviors()
+@register_analysis
+class ProductInsightsAnalysis(AnalysisPlugin):
+    """Most consulted products - count once per user session."""
 
-    def _detect_time_gaps(self) -> None:
-        """Detect unusually long gaps between events."""
-        long_gaps = []
+    name = 'product_insights'
+    fields = ('path',)
 
-        for user_id, sessions in self.user_sessions.items():
-            for session_id, events in sessions.items():
-                if len(events) < 2:
-                    continue
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        # Sessions per product, and in total under None
+        self.product_sessions = SampleUnitCounter()
 
-                for i in range(1, len(events)):
-                    try:
-                        prev_time = datetime.fromisoformat(events[i-1]['event_time'].replace('Z', '+00:00'))
-                        curr_time = datetime.fromisoformat(events[i]['event_time'].replace('Z', '+00:00'))
-                        gap_seconds = (curr_time - prev_time).total_seconds()
-
-                        # Flag gaps longer than 5 minutes as potential user confusion
-                        if gap_seconds > 300:
-                            long_gaps.append({
-                                'user_id': user_id,
-                                'session_id': session_id,
-                                'gap_minutes': gap_seconds / 60,
-                                'stuck_on_page': events[i-1]['path'],
-                                'next_page': events[i]['path']
-                            })
-                    except (ValueError, AttributeError) as e:
-                        # Skip events with invalid timestamps
-                        continue
-
-        if long_gaps:
-            # Group by page for better organization
-            page_gaps = defaultdict(list)
-            for gap in long_gaps:
-                page_gaps[gap['stuck_on_page']].append(gap)
-
-            # Sort by gap length
-            long_gaps.sort(key=lambda x: x['gap_minutes'], reverse=True)
-
-            self.anomalies.append({
-                'title': 'User Confusion / Long Delays',
-                'description': f'Found {len(long_gaps)} instances of users spending >5 minutes on a page',
-                'severity': 'High' if len(long_gaps) > 10 else 'Medium',
+    def visit_session(self, user_id: str, session_id: str, events: List[Event]) -> None:
+        # Get unique products viewed in this session
+        products_in_session = set()
+        for event in events:
+            path = event.path
+            # Look for product pages that start with /products/
+            if path.startswith('/products/'):
+                products_in_session.add(path)
+
+        # Count each unique product once per session
+        unit = self.analyzer.sample_unit(events[0])
+        for product in products_in_session:
+            self.product_sessions.add(unit, None, product)
+
+    def finish(self) -> None:
+        analyzer = self.analyzer
+        product_sessions = self.product_sessions
+        product_sessions.finish()
+        if product_sessions.counts[None]:
+            # Calculate total sessions that viewed products
+            total_product_sessions = analyzer.scaled(product_sessions.counts[None], product_sessions.squares[None])
+
+            analyzer.flows.append({
+                'title': 'Most Consulted Products',
+                'description': f'Analysis of products viewed across {total_product_sessions} user sessions',
                 'details': {
-                    'total_instances': len(long_gaps),
-                    'average_gap': f"{statistics.mean([g['gap_minutes'] for g in long_gaps]):.1f} minutes",
-                    'longest_gap': f"{max(long_gaps, key=lambda x: x['gap_minutes'])['gap_minutes']:.1f} minutes",
-                    'page_specific_issues': page_gaps,
-                    'examples': long_gaps[:3]
+                    'total_product_sessions': total_product_sessions,
+                    'unique_products': len(product_sessions.counts) - 1,
+                    'top_products': analyzer.scaled_most_common(product_sessions, 10)
                 }
             })
 
-    def _detect_error_patterns(self) -> None:
-        """Detect error-related patterns in CSS selectors and text."""
-        error_events = []
-        page_errors = defaultdict(list)
 
-        for event in self.events:
-            css = event.get('css', '').lower()
-            text = event.get('text', '').lower()
+@register_analysis
+class PageActivityAnalysis(AnalysisPlugin):
+    """Pages with longest user activity."""
+
+    name = 'page_activity'
+    scope = 'transition'
+    fields = ('path',)
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        # path -> [count, total microseconds] of the time spent on it
+        self.page_durations = {}
+
+    def visit_transition(self, user_id: str, session_id: str, previous: Event, current: Event) -> None:
+        duration_us = current.timestamp_us - previous.timestamp_us
+
+        # Only count reasonable durations (less than 30 minutes)
+        if 0 < duration_us < 1800 * MICROSECONDS_PER_SECOND:
+            totals = self.page_durations.get(previous.path)
+            if totals is None:
+                totals = self.page_durations[previous.path] = [0, 0]
+            totals[0] += 1
+            totals[1] += duration_us
+
+    def finish(self) -> None:
+        # Calculate average duration per page
+        page_avg_durations = {path: total_us / count / MICROSECONDS_PER_SECOND
+                              for path, (count, total_us) in self.page_durations.items()}
+
+        if page_avg_durations:
+            # Sort by average duration
+            sorted_pages = sorted(page_avg_durations.items(), key=lambda x: x[1], reverse=True)
+
+            self.analyzer.flows.append({
+                'title': 'Pages with Longest Activity',
+                'description': f'Analysis of user time spent on {len(sorted_pages)} different pages',
+                'details': {
+                    'total_pages_analyzed': len(sorted_pages),
+                    'longest_activity_pages': [(path, f"{duration:.1f}s") for path, duration in sorted_pages[:10]],
+                    'average_page_time': f"{statistics.mean(page_avg_durations.values()):.1f}s"
+                }
+            })
 
-            # Look for error-related keywords
-            error_keywords = ['error', '404', 'timeout', 'failed', 'invalid', 'missing']
 
-            if any(keyword in css or keyword in text for keyword in error_keywords):
-                error_info = {
-                    'event': event,
-                    'error_type': 'CSS/Text contains error keywords',
-                    'text': event.get('text', 'N/A'),
-                    'css': event.get('css', 'N/A')
+@register_analysis
+class TimeGapDetector(AnalysisPlugin):
+    """Unusually long gaps between events.
+
+    Gaps are counted per page as they come; only the longest gaps are kept
+    as examples.
+    """
+
+    name = 'time_gaps'
+    scope = 'transition'
+    fields = ('path',)
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        # Gaps per sampled unit: several gaps of one unit widen the sampling error
+        self.gaps = SampleUnitCounter()
+        self.total_gap_us = 0
+        # stuck_on_page -> longest gap in minutes, in order of first gap
+        self.longest_page_gaps = {}
+        # Min-heap of (gap_minutes, -arrival, gap) holding the longest gaps, earliest first among equals
+        self.longest_gaps = []
+
+    def visit_transition(self, user_id: str, session_id: str, previous: Event, current: Event) -> None:
+        gap_us = current.timestamp_us - previous.timestamp_us
+
+        # Flag gaps longer than 5 minutes as potential user confusion
+        if gap_us > 300 * MICROSECONDS_PER_SECOND:
+            gap_minutes = gap_us / MICROSECONDS_PER_SECOND / 60
+            page = previous.path
+            self.gaps.add(self.analyzer.sample_unit(previous), None, page)
+            self.total_gap_us += gap_us
+            self.longest_page_gaps[page] = max(self.longest_page_gaps.get(page, 0), gap_minutes)
+
+            item = (gap_minutes, -self.gaps.counts[None], {
+                'user_id': user_id,
+                'session_id': previous.session_id,
+                'gap_minutes': gap_minutes,
+                'stuck_on_page': page,
+                'next_page': current.path
+            })
+            if len(self.longest_gaps) < MAX_EXAMPLES:
+                heapq.heappush(self.longest_gaps, item)
+            elif item[:2] > self.longest_gaps[0][:2]:
+                heapq.heapreplace(self.longest_gaps, item)
+
+    def finish(self) -> None:
+        analyzer = self.analyzer
+        gaps = self.gaps
+        gaps.finish()
+        gap_count = gaps.counts[None]
+        if gap_count:
+            total_instances = analyzer.scaled(gap_count, gaps.squares[None])
+            page_gaps = {page: (analyzer.scaled(gaps.counts[page], gaps.squares[page]), longest)
+                         for page, longest in self.longest_page_gaps.items()}
+            examples = [gap for _, _, gap in sorted(self.longest_gaps, key=itemgetter(0, 1), reverse=True)]
+
+            analyzer.anomalies.append({
+                'title': 'User Confusion / Long Delays',
+                'description': f'Found {total_instances} instances of users spending >5 minutes on a page',
+                'severity': 'High' if gap_count / (analyzer.sampler.rate if analyzer.sampler else 1) > 10 else 'Medium',
+                'details': {
+                    'total_instances': total_instances,
+                    'average_gap': f"{self.total_gap_us / gap_count / MICROSECONDS_PER_SECOND / 60:.1f} minutes",
+                    'longest_gap': f"{examples[0]['gap_minutes']:.1f} minutes",
+                    'page_specific_issues': page_gaps,
+                    'examples': examples[:3]
                 }
-                error_events.append(error_info)
-                page_errors[event['path']].append(error_info)
+            })
+
 
-        if error_events:
-            self.anomalies.append({
+@register_analysis
+class ErrorPatternDetector(AnalysisPlugin):
+    """Error-related patterns in CSS selectors and text."""
+
+    name = 'error_patterns'
+    scope = 'event'
+    fields = ('path', 'css', 'text')
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        # Error events in total, per page and per (page, text)
+        self.errors = SampleUnitCounter()
+        # path -> Counter of the texts of its error events (None for events without text)
+        self.page_errors = {}
+
+    def visit_event(self, user_id: str, session_id: str, event: Event) -> None:
+        css = (event.css or '').lower()
+        text = (event.text or '').lower()
+
+        if any(keyword in css or keyword in text for keyword in ERROR_KEYWORDS):
+            self.errors.add(self.analyzer.sample_unit(event), None, event.path, (event.path, event.text))
+            texts = self.page_errors.get(event.path)
+            if texts is None:
+                texts = self.page_errors[event.path] = Counter()
+            texts[event.text] += 1
+
+    def finish(self) -> None:
+        analyzer = self.analyzer
+        errors = self.errors
+        errors.finish()
+        if errors.counts[None]:
+            total_errors = analyzer.scaled(errors.counts[None], errors.squares[None])
+            # path -> (error count, most common error texts with their counts)
+            page_errors = {}
+            for path, texts in self.page_errors.items():
+                text_counts = Counter({text: count for text, count in texts.items() if text is not None})
+                page_errors[path] = (
+                    analyzer.scaled(errors.counts[path], errors.squares[path]),
+                    [(text, analyzer.scaled(count, errors.squares[(path, text)]))
+                     for text, count in text_counts.most_common(3)])
+
+            analyzer.anomalies.append({
                 'title': 'Technical Errors',
-                'description': f'Found {len(error_events)} events with error-related keywords',
+                'description': f'Found {total_errors} events with error-related keywords',
                 'severity': 'High',
                 'details': {
-                    'total_errors': len(error_events),
+                    'total_errors': total_errors,
                     'page_specific_errors': page_errors
                 }
             })
 
-    def _detect_unusual_behaviors(self) -> None:
-        """Detect unusual user behaviors."""
-        # Detect sessions with unusually high event counts
-        session_lengths = []
-        for user_id, sessions in self.user_sessions.items():
-            for session_id, events in sessions.items():
-                session_lengths.append(len(events))
-
-        if session_lengths:
-            avg_length = statistics.mean(session_lengths)
-            threshold = avg_length + 2 * statistics.stdev(session_lengths) if len(session_lengths) > 1 else avg_length * 2
 
-            unusual_sessions = []
-            for user_id, sessions in self.user_sessions.items():
-                for session_id, events in sessions.items():
-                    if len(events) > threshold:
-                        unusual_sessions.append({
-                            'user_id': user_id,
-                            'session_id': session_id,
-                            'event_count': len(events),
-                            'duration_minutes': self._calculate_session_duration(events)
-                        })
-
-            if unusual_sessions:
-                self.anomalies.append({
+@register_analysis
+class UnusualBehaviorDetector(AnalysisPlugin):
+    """Sessions with unusually high event counts.
+
+    The threshold depends on every session length, which is only known at
+    the end, so a histogram of session lengths is kept instead of the
+    sessions. Examples are the first sessions above the threshold: a
+    session can only be one of them if fewer than MAX_EXAMPLES earlier
+    sessions were at least as long, so only those are kept as candidates.
+
+    The CI of the scaled count needs the squared number of unusual sessions
+    per sampled unit, which is the number of ordered pairs of sessions of a
+    unit that are both above the threshold. A histogram of the shorter
+    length of each such pair gives it for any threshold.
+    """
+
+    name = 'unusual_sessions'
+    scope = 'summary'
+    fields = ()
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        self.session_lengths = Counter()
+        # Shorter length of each ordered pair of sessions of one sampled unit -> number of pairs
+        self.pair_lengths = Counter()
+        self.unit = None
+        self.unit_lengths = []
+        self.candidates = []
+        # Min-heap of the MAX_EXAMPLES longest session lengths so far
+        self.longest = []
+
+    def visit_summary(self, summary: SessionSummary) -> None:
+        event_count = summary.event_count
+        self.session_lengths[event_count] += 1
+        if summary.sample_unit != self.unit:
+            self._close_unit()
+            self.unit = summary.sample_unit
+        self.unit_lengths.append(event_count)
+        if len(self.longest) < MAX_EXAMPLES:
+            heapq.heappush(self.longest, event_count)
+        elif event_count > self.longest[0]:
+            heapq.heapreplace(self.longest, event_count)
+        else:
+            return
+        self.candidates.append(summary)
+
+    def _close_unit(self) -> None:
+        # The i-th longest session is the shorter one of 2i + 1 ordered pairs with itself and the longer ones
+        for index, length in enumerate(sorted(self.unit_lengths, reverse=True)):
+            self.pair_lengths[length] += 2 * index + 1
+        self.unit_lengths.clear()
+
+    def finish(self) -> None:
+        analyzer = self.analyzer
+        session_lengths = self.session_lengths
+        self._close_unit()
+        session_count = sum(session_lengths.values())
+
+        if session_count:
+            total = sum(length * count for length, count in session_lengths.items())
+            avg_length = total / session_count
+            if session_count > 1:
+                squares = sum(length * length * count for length, count in session_lengths.items())
+                variance = Fraction(session_count * squares - total * total, session_count * (session_count - 1))
+                threshold = avg_length + 2 * math.sqrt(variance)
+            else:
+                threshold = avg_length * 2
+
+            unusual_count = sum(count for length, count in session_lengths.items() if length > threshold)
+            unusual_squares = sum(count for length, count in self.pair_lengths.items() if length > threshold)
+            unusual_sessions = [{
+                'user_id': summary.user_id,
+                'session_id': summary.session_id,
+                'event_count': summary.event_count,
+                'duration_minutes': summary.duration_minutes
+            } for summary in self.candidates if summary.event_count > threshold][:MAX_EXAMPLES]
+
+            if unusual_count:
+                analyzer.anomalies.append({
                     'title': 'Unusual Session Activity',
-                    'description': f'Found {len(unusual_sessions)} sessions with unusually high activity',
+                    'description': f'Found {analyzer.scaled(unusual_count, unusual_squares)} sessions with '
+                                   f'unusually high activity',
                     'severity': 'Medium',
                     'details': {
                         'average_session_length': f"{avg_length:.1f} events",
                         'threshold': f"{threshold:.1f} events",
-                        'unusual_sessions': unusual_sessions[:5]
+                        'unusual_sessions': unusual_sessions
                     }
                 })
 
-    def _calculate_session_duration(self, events: List[Dict]) -> float:
-        """Calculate session duration in minutes."""
-        if len(events) < 2:
-            return 0
 
-        try:
-            start_time = datetime.fromisoformat(events[0]['event_time'].replace('Z', '+00:00'))
-            end_time = datetime.fromisoformat(events[-1]['event_time'].replace('Z', '+00:00'))
-            return (end_time - start_time).total_seconds() / 60
-        except (ValueError, AttributeError):
-            return 0
+class SampleUnitSizes(AnalysisPlugin):
+    """Squared session and event counts per sampled unit, for the CIs of the report totals.
+
+    The sessions of a unit (a session_id, or a user_id when sampling users)
+    come out of the store one after the other, so each unit is closed as
+    soon as the next one starts. Added by the analyzer when sampling rather
+    than registered.
+    """
+
+    name = 'sample_unit_sizes'
+    fields = ()
+
+    def __init__(self, analyzer: 'UserFlowAnalyzer'):
+        super().__init__(analyzer)
+        self.unit = None
+        self.unit_sessions = self.unit_events = 0
+        self.session_squares = self.event_squares = 0
+
+    def visit_session(self, user_id: str, session_id: str, events: List[Event]) -> None:
+        unit = self.analyzer.sample_unit(events[0])
+        if unit != self.unit:
+            self._close_unit()
+            self.unit = unit
+        self.unit_sessions += 1
+        self.unit_events += len(events)
+
+    def _close_unit(self) -> None:
+        self.session_squares += self.unit_sessions ** 2
+        self.event_squares += self.unit_events ** 2
+        self.unit_sessions = self.unit_events = 0
+
+    def finish(self) -> None:
+        self._close_unit()
+        self.analyzer.sample_unit_squares = (self.session_squares, self.event_squares)
+
+
+class UserFlowAnalyzer:
+    def __init__(self, data_source: Union[str, InputSource] = DEFAULT_DATA_URL,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, json_backend: str = 'auto',
+                 store: Optional[EventStore] = None, ingest_workers: int = 1,
+                 snapshots: Optional[SnapshotCache] = None, deduplicator: Optional[Deduplicator] = None,
+                 quarantine: Optional[QuarantineWriter] = None, sampler: Optional[SessionSampler] = None,
+                 analyses: Optional[List[str]] = None):
+        if isinstance(data_source, InputSource):
+            self.source = data_source
+        else:
+            self.source = open_source(data_source, chunk_size)
+        self.parser = EventParser(json_backend, quarantine, sampler)
+        self.sampler = sampler
+        # Sampled unit of an event: its session, or its user when sampling by user_id. It is read from
+        # the event, whose session_id is the one of the input rather than a re-cut one
+        self.sample_unit = attrgetter(sampler.key if sampler is not None else 'session_id')
+        self.ingest_workers = ingest_workers
+        self.store = store if store is not None else InMemoryEventStore()
+        self.snapshots = snapshots
+        self.deduplicator = deduplicator
+        self.duplicate_events = 0
+        self.session_owners = SessionOwnershipIndex()
+        # SessionOwnershipIndex.counts() of the input, filled by load_data() or restored from a snapshot
+        self.session_conflicts = self.session_owners.counts()
+        # Names of the enabled ANALYSIS_PLUGINS, all of them by default
+        self.analysis_names = list(ANALYSIS_PLUGINS) if analyses is None else list(analyses)
+        unknown = [name for name in self.analysis_names if name not in ANALYSIS_PLUGINS]
+        if unknown:
+            raise ValueError(f"Unknown analysis plugin(s): {', '.join(unknown)} "
+                             f"(available: {', '.join(ANALYSIS_PLUGINS)})")
+        self.analyses = {}
+        self.flows = []
+        self.anomalies = []
+        # (sessions², events²) summed per sampled unit, filled by analyze_sessions() when sampling
+        self.sample_unit_squares = (0, 0)
+
+    def load_data(self) -> None:
+        """Load JSON Lines data from the configured input source."""
+        reader = 'columnar input' if self.source.columnar else f"JSON backend: {self.parser.decoder.name}"
+        print(f"Loading data from {self.source.description} ({reader})...")
+
+        for event in self.iter_events():
+            self.store.add(event)
+
+        print(f"Loaded {self.parser.valid} valid events")
+        if self.sampler is not None:
+            print(f"Skipped {self.parser.sampled_out} valid events outside the {self.sampler.rate:.2%} session sample")
+        if self.parser.invalid > 0:
+            top_reasons = ', '.join(f"{reason}: {count}" for reason, count in self.parser.quality.reasons.most_common(3))
+            print(f"Skipped {self.parser.invalid} invalid events ({top_reasons})")
+        if self.parser.quarantine is not None:
+            print(f"Quarantined {self.parser.quarantine.count} rejected lines to {self.parser.quarantine.path}")
+        if self.deduplicator is not None:
+            self.duplicate_events = self.deduplicator.duplicates
+            print(f"Dropped {self.duplicate_events} duplicate events ({self.deduplicator.description})")
+        self.session_conflicts = self.session_owners.counts()
+        if self.session_conflicts['shared_sessions']:
+            print(f"Found {self.session_conflicts['shared_sessions']} session_ids shared by several user_ids "
+                  f"({self.session_conflicts['conflicting_events']} events outside the first user)")
+        if self.parser.timestamp_parser.fallbacks > 0:
+            print(f"Parsed {self.parser.timestamp_parser.fallbacks} timestamps outside the fixed "
+                  f"'YYYY-MM-DD HH:MM:SS' layout with the generic parser")
+
+    def iter_events(self) -> Iterator[Event]:
+        """Stream validated events from the input source without holding it whole in memory."""
+        if self.source.columnar:
+            columns = ANALYSIS_FIELDS if self.deduplicator is None else ('uuid',) + ANALYSIS_FIELDS
+            events = self.parser.parse_record_batches(self.source.iter_record_batches(columns))
+        elif self.ingest_workers > 1:
+            events = parse_events_parallel(self.source, self.parser, self.ingest_workers)
+        else:
+            events = self.parser.parse(self.source.iter_lines())
+
+        # De-duplication runs here, in input order, so it also spans the parallel workers
+        if self.deduplicator is not None:
+            events = self.deduplicator.filter(events)
+        return self.session_owners.filter(events)
+
+    def snapshot_config(self) -> Dict:
+        """Ingest settings that change the content of the finalized store, part of the snapshot key."""
+        store = self.store
+        config = {}
+        if isinstance(store, SessionizedEventStore):
+            config['sessionize'] = [store.sessionizer.mode, store.sessionizer.timeout]
+            store = store.store
+        config['store'] = type(store).__name__
+        if self.deduplicator is not None:
+            config['dedup'] = self.deduplicator.description
+        if self.sampler is not None:
+            config['sample'] = self.sampler.rate
+            config['sample_key'] = self.sampler.key
+        return config
+
+    def ingest_stats(self) -> Dict:
+        """Counters of the ingest stage, saved with snapshots so reports stay identical."""
+        return {'parser': self.parser.counts(), 'quality': self.parser.quality, 'duplicates': self.duplicate_events,
+                'session_conflicts': self.session_conflicts}
+
+    def restore_ingest_stats(self, stats: Dict) -> None:
+        self.parser.add_counts(stats['parser'])
+        self.parser.quality = stats['quality']
+        self.duplicate_events = stats['duplicates']
+        self.session_conflicts = stats['session_conflicts']
+
+    def _snapshot_key(self) -> Optional[str]:
+        if self.snapshots is None or not self.store.snapshottable:
+            return None
+        fingerprint = self.source.fingerprint()
+        if fingerprint is None:
+            return None
+        return self.snapshots.key(fingerprint, self.snapshot_config())
+
+    def load_snapshot(self, key: Optional[str]) -> bool:
+        """Restore the finalized store saved by an earlier run on the same input, if there is one."""
+        # Only reading the input again can fill a quarantine file
+        if key is None or self.parser.quarantine is not None:
+            return False
+        snapshot = self.snapshots.load(key)
+        if snapshot is None:
+            return False
+
+        self.store, stats = snapshot
+        self.restore_ingest_stats(stats)
+        print(f"Loaded snapshot of {self.source.description}: {self.store.event_count} events, "
+              f"{self.store.user_count} users, {self.store.session_count} sessions")
+        return True
+
+    def save_snapshot(self, key: Optional[str]) -> None:
+        if key is None:
+            return
+        path = self.snapshots.save(key, self.store, self.ingest_stats())
+        print(f"Saved snapshot to {path}")
+
+    def process_events(self) -> None:
+        """Process events and group by user and session."""
+        print("Processing events...")
+
+        # Sort and group the events by user_id and session_id
+        self.store.finalize()
+
+        if not self.store.event_count:
+            print("No valid events to process")
+            return
+
+        print(f"Found {self.store.user_count} unique users")
+        if self.store.session_count is None:
+            print("Sessions are counted as the partitions are analyzed")
+        else:
+            print(f"Found {self.store.session_count} unique sessions")
+
+    def _schedule_analyses(self) -> List[List[AnalysisPlugin]]:
+        """Instantiate the enabled analysis plugins and split them into passes."""
+        plugins = [ANALYSIS_PLUGINS[name](self) for name in self.analysis_names]
+        if self.sampler is not None:
+            plugins.append(SampleUnitSizes(self))
+        self.analyses = {plugin.name: plugin for plugin in plugins}
+        return schedule_analyses(plugins)
+
+    def analyze_sessions(self) -> None:
+        """Run the enabled analysis plugins, in as few passes over the sessions as their requirements allow."""
+        passes = self._schedule_analyses()
+        print(f"Analyzing flows and anomalies ({len(self.analyses)} analyses in {len(passes)} "
+              f"pass{'es' if len(passes) > 1 else ''} over the sessions)...")
+        for plugins in passes:
+            fields, visit = self._session_visitor(plugins)
+            for user_id, session_id, events in self.store.iter_sessions(fields):
+                visit(user_id, session_id, events)
+            for plugin in plugins:
+                plugin.finish()
+        if self.store.session_count is None:
+            # Without analyses nothing has read the sessions of a store that counts them as they are read
+            for _ in self.store.iter_sessions(fields=()):
+                pass
+        self._report_session_conflicts()
+
+    def analyze_streaming(self) -> None:
+        """Ingest and analyze at once, feeding each session to the plugins as soon as the streaming store closes it."""
+        passes = self._schedule_analyses()
+        if len(passes) > 1:
+            raise ValueError("A streaming store analyzes each session once as it closes, but "
+                             f"{', '.join(plugin.name for plugin in passes[1])} need the finished results of "
+                             f"other analyses")
+        print(f"Analyzing flows and anomalies as sessions close ({len(self.analyses)} analyses)...")
+        # Sessions are still closed and counted when no analysis is enabled
+        plugins = passes[0] if passes else []
+        _, self.store.on_session = self._session_visitor(plugins)
+        self.load_data()
+        self.process_events()
+        print(f"At most {self.store.peak_active_sessions} sessions were open at once; "
+              f"{self.store.late_events} late events without an open session were "
+              f"{'dropped' if self.store.late_policy == 'drop' else 'kept as separate sessions'}")
+        for plugin in plugins:
+            plugin.finish()
+        self._report_session_conflicts()
+
+    def _report_session_conflicts(self) -> None:
+        """Add the session_ids that the ingest-time SessionOwnershipIndex saw with several users as an anomaly."""
+        conflicts = self.session_conflicts
+        if not conflicts['shared_sessions']:
+            return
+        shared_sessions = self.scaled(conflicts['shared_sessions'])
+        # Events are only counted in the sample, the per-session spread they would need to be scaled is not kept
+        events_key = 'events_outside_first_user' if self.sampler is None else 'events_outside_first_user_in_sample'
+        self.anomalies.append({
+            'title': 'Sessions Shared Across Users',
+            'description': f'Found {shared_sessions} session_ids used by more than one user_id; their events are '
+                           f'analyzed as separate sessions of each user',
+            'severity': 'High',
+            'details': {
+                'shared_sessions': shared_sessions,
+                events_key: conflicts['conflicting_events'],
+                'examples': conflicts['examples'],
+            }
+        })
+
+    def _session_visitor(self, plugins: List[AnalysisPlugin]) -> Tuple[Tuple[str, ...], Callable]:
+        """The event fields a pass reads, and a function feeding one session to every plugin of the pass."""
+        session_visits = [plugin.visit_session for plugin in plugins if plugin.scope == 'session']
+        summary_visits = [plugin.visit_summary for plugin in plugins if plugin.scope == 'summary']
+        event_visits = [plugin.visit_event for plugin in plugins if plugin.scope == 'event']
+        transition_visits = [plugin.visit_transition for plugin in plugins if plugin.scope == 'transition']
+        read = {field for plugin in plugins for field in plugin.fields}
+        if summary_visits:
+            read.update(SUMMARY_FIELDS)
+        fields = tuple(field for field in ANALYSIS_FIELDS if field in read)
+
+        def visit_session(user_id: str, session_id: str, events: List[Event]) -> None:
+            for visit in session_visits:
+                visit(user_id, session_id, events)
+            if summary_visits:
+                summary = self.summarize_session(user_id, session_id, events)
+                for visit in summary_visits:
+                    visit(summary)
+            for visit in event_visits:
+                for event in events:
+                    visit(user_id, session_id, event)
+            for visit in transition_visits:
+                for previous, current in zip(events, itertools.islice(events, 1, None)):
+                    visit(user_id, session_id, previous, current)
+
+        return fields, visit_session
+
+    def scaled(self, count: int, sum_of_squares: Optional[float] = None) -> Union[int, str]:
+        """A count measured on the sample, scaled to the whole input with its 95% CI when sampling.
+
+        `sum_of_squares` is the sum of the squared per-unit contributions,
+        for counts to which a sampled unit can contribute more than once (see
+        estimate_total()). It defaults to one per counted item.
+        """
+        if self.sampler is None:
+            return count
+        estimate, low, high = estimate_total(count, self.sampler.rate, sum_of_squares)
+        return f"≈{estimate:,.0f} (95% CI {low:,.0f}–{high:,.0f})"
+
+    def scaled_most_common(self, counter: SampleUnitCounter, n: int) -> List[Tuple[Any, Union[int, str]]]:
+        """The n largest counts of a finished SampleUnitCounter, leaving out its None total, as scaled()."""
+        counts = Counter({key: count for key, count in counter.counts.items() if key is not None})
+        return [(key, self.scaled(count, counter.squares[key])) for key, count in counts.most_common(n)]
+
+    def share(self, count: int, total: int) -> str:
+        """A percentage of sessions, with its 95% CI when sampling."""
+        share = f"{count / total * 100:.1f}%"
+        if self.sampler is None:
+            return share
+        low, high = wilson_interval(count, total)
+        return f"{share} (95% CI {low * 100:.1f}–{high * 100:.1f}%)"
+
+    def _is_successful_checkout(self, events: List[Event]) -> bool:
+        """Improved checkout detection with deduplication and content analysis."""
+        checkout_events = []
+
+        # Find all checkout events in the session
+        for event in events:
+            if event.path == '/checkout':
+                checkout_events.append(event)
+
+        if not checkout_events:
+            return False
+
+        # Check each checkout event for success indicators
+        for checkout_event in checkout_events:
+            css = (checkout_event.css or '').lower()
+            text = (checkout_event.text or '').lower()
+
+            # Check for failure indicators
+            if 'error' in css or 'error' in text:
+                continue
+            if 'cancel' in css or 'cancel' in text:
+                continue
+
+            # Check for success indicator
+            if 'place order' in text:
+                return True
+
+        return False
+
+    def summarize_session(self, user_id: str, session_id: str, events: List[Event]) -> SessionSummary:
+        """Reduce a time-ordered session to a SessionSummary, after which its events can be released."""
+        path_sequence = None
+        outcome = OUTCOME_ABANDONED
+        if self._is_successful_checkout(events):
+            path_sequence = tuple(map(attrgetter('path'), events))
+            outcome = OUTCOME_CONVERTED
+        return SessionSummary(user_id, session_id, self.sample_unit(events[0]), events[0].path, events[-1].path,
+                              path_sequence, events[0].timestamp_us, events[-1].timestamp_us, len(events), outcome)
 
     def generate_html_report(self) -> str:
         """Generate HTML report with findings."""
         print("Generating HTML report...")
 
         # Calculate average sessions per user
-        total_sessions = sum(len(sessions) for sessions in self.user_sessions.values())
-        avg_sessions_per_user = total_sessions / len(self.user_sessions) if self.user_sessions else 0
+        total_sessions = self.store.session_count
+        avg_sessions_per_user = total_sessions / self.store.user_count if self.store.user_count else 0
+
+        sample_note = ""
+        session_total = total_sessions
+        event_total = self.store.event_count
+        users_label = "Unique Users"
+        avg_sessions_label = "Avg Sessions/User"
+        if self.sampler is not None:
+            sampled = 'users' if self.sampler.key == 'user_id' else 'sessions'
+            sample_note = (f"<p>Sampled report: {self.sampler.rate:.2%} of {sampled}, chosen by a hash of "
+                           f"{self.sampler.key}. Counts marked ≈ are scaled to the whole input with 95% confidence "
+                           f"intervals.</p>")
+            session_squares, event_squares = self.sample_unit_squares
+            session_total = self.scaled(total_sessions, session_squares)
+            event_total = self.scaled(self.store.event_count, event_squares)
+            users_label = "Unique Users (in sample)"
+            # Whole users keep the ratio, but sampling sessions favours and truncates users with many sessions
+            avg_sessions_label = "Avg Sessions/User (in sample)" if self.sampler.key == 'user_id' else None
+
+        if isinstance(self.store, SessionizedEventStore):
+            sample_note += (f"<p>Sessions re-cut by inactivity ({self.store.sessionizer.description}): "
+                            f"{self.store.original_session_count} sessions in the input became "
+                            f"{total_sessions}.</p>")
+        if self.store.streaming:
+            late_outcome = 'dropped' if self.store.late_policy == 'drop' else 'analyzed as separate sessions'
+            sample_note += (f"<p>Streamed report: sessions were closed after {self.store.timeout / 60:g} minutes "
+                            f"without events, behind a watermark trailing the newest event by "
+                            f"{self.store.allowed_lateness / 60:g} minutes; {self.store.late_events} late events "
+                            f"without an open session were {late_outcome}.</p>")
+
+        avg_sessions_card = ""
+        if avg_sessions_label is not None:
+            avg_sessions_card = f"""
+        <div class="summary-card">
+            <div class="summary-number">{avg_sessions_per_user:.1f}</div>
+            <div class="summary-label">{avg_sessions_label}</div>
+        </div>"""
+
+        duplicates_card = ""
+        if self.deduplicator is not None:
+            duplicates_card = f"""
+        <div class="summary-card">
+            <div class="summary-number">{self.duplicate_events}</div>
+            <div class="summary-label">Duplicate Events Dropped</div>
+            <div class="timestamp">{self.deduplicator.description}</div>
+        </div>"""
 
         html = f"""
 <!DOCTYPE html>
@@ -550,31 +3615,39 @@ class UserFlowAnalyzer:
             color: #95a5a6;
             font-size: 0.9em;
         }}
+        table {{
+            border-collapse: collapse;
+            margin-top: 10px;
+        }}
+        th, td {{
+            padding: 6px 15px;
+            border-bottom: 1px solid #ecf0f1;
+            text-align: right;
+        }}
+        th:first-child, td:first-child {{
+            text-align: left;
+        }}
     </style>
 </head>
 <body>
     <div class="header">
         <h1>User Flow Analysis Report</h1>
-        <p>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        <p>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>{sample_note}
     </div>
 
     <div class="summary">
         <div class="summary-card">
-            <div class="summary-number">{len(self.user_sessions)}</div>
-            <div class="summary-label">Unique Users</div>
+            <div class="summary-number">{self.store.user_count}</div>
+            <div class="summary-label">{users_label}</div>
         </div>
         <div class="summary-card">
-            <div class="summary-number">{total_sessions}</div>
+            <div class="summary-number">{session_total}</div>
             <div class="summary-label">Total Sessions</div>
-        </div>
+        </div>{avg_sessions_card}
         <div class="summary-card">
-            <div class="summary-number">{avg_sessions_per_user:.1f}</div>
-            <div class="summary-label">Avg Sessions/User</div>
-        </div>
-        <div class="summary-card">
-            <div class="summary-number">{len(self.events)}</div>
+            <div class="summary-number">{event_total}</div>
             <div class="summary-label">Total Events</div>
-        </div>
+        </div>{duplicates_card}
         <div class="summary-card">
             <div class="summary-number">{len(self.anomalies)}</div>
             <div class="summary-label">Anomalies Detected</div>
@@ -590,12 +3663,50 @@ class UserFlowAnalyzer:
         <h2>🚨 Detected Anomalies</h2>
         {self._generate_anomalies_html()}
     </div>
+
+    <div class="section">
+        <h2>🧪 Data Quality</h2>
+        {self._generate_data_quality_html()}
+    </div>
 </body>
 </html>
         """
 
         return html
 
+    def _generate_data_quality_html(self) -> str:
+        """Generate HTML for the data quality section: rejections and per-field problems."""
+        quality = self.parser.quality
+        accepted = self.parser.valid + self.parser.sampled_out
+        total = accepted + self.parser.invalid
+        rejected_share = self.parser.invalid / total * 100 if total else 0
+
+        html = f"""
+            <div class="metric success">{accepted} events accepted</div>
+            <div class="metric {'danger' if rejected_share > 5 else 'warning'}">{self.parser.invalid} lines rejected ({rejected_share:.2f}%)</div>
+            """
+        if self.parser.quarantine is not None:
+            html += f"<p>Rejected lines were written with their reason codes to <code>{self.parser.quarantine.path}</code>.</p>"
+
+        if quality.reasons:
+            html += "<h3>Rejection reasons</h3><ul>"
+            for reason, count in quality.reasons.most_common():
+                html += f"<li><code>{reason}</code>: {count}</li>"
+            html += "</ul>"
+
+        rows = [(field, problems) for field, problems in quality.field_problems.items() if any(problems.values())]
+        if not rows:
+            html += "<p>No missing, null or malformed values.</p>"
+            return html
+
+        html += "<h3>Field completeness</h3><table><tr><th>Field</th>"
+        html += ''.join(f"<th>{problem.capitalize()}</th>" for problem in FIELD_PROBLEMS) + "</tr>"
+        for field, problems in rows:
+            html += f"<tr><td>{field}</td>" + ''.join(f"<td>{problems[problem]}</td>" for problem in FIELD_PROBLEMS)
+            html += "</tr>"
+        html += "</table>"
+        return html
+
     def _generate_flows_html(self) -> str:
         """Generate HTML for user flows section."""
         if not self.flows:
@@ -699,36 +3810,28 @@ class UserFlowAnalyzer:
         for key, value in details.items():
             if key == 'page_specific_issues' and isinstance(value, dict):
                 html += f"<strong>Issues by Page:</strong>"
-                for page, issues in value.items():
+                for page, (issue_count, longest_gap) in value.items():
                     html += f"""
                     <div class="page-section">
-                        <div class="page-title">{page} ({len(issues)} issues)</div>
+                        <div class="page-title">{page} ({issue_count} issues)</div>
                         <ul>
                     """
-                    # Show most common example for this page
-                    if issues:
-                        example = max(issues, key=lambda x: x.get('gap_minutes', 0))
-                        if 'gap_minutes' in example:
-                            html += f"<li>Longest delay: {example['gap_minutes']:.1f} minutes</li>"
+                    html += f"<li>Longest delay: {longest_gap:.1f} minutes</li>"
                     html += "</ul></div>"
             elif key == 'page_specific_errors' and isinstance(value, dict):
                 html += f"<strong>Errors by Page:</strong>"
-                for page, errors in value.items():
-                    # Count error texts for this page
-                    error_texts = [e['text'] for e in errors if e['text'] != 'N/A']
-                    error_text_counts = Counter(error_texts)
-
+                for page, (error_count, error_texts) in value.items():
                     html += f"""
                     <div class="page-section">
-                        <div class="page-title">{page} ({len(errors)} errors)</div>
+                        <div class="page-title">{page} ({error_count} errors)</div>
                         <ul>
                     """
                     # Show most common error texts for this page
-                    if error_text_counts:
-                        for error_text, count in error_text_counts.most_common(3):
+                    if error_texts:
+                        for error_text, count in error_texts:
                             html += f"<li>'{error_text}': {count} occurrences</li>"
                     else:
-                        html += f"<li>CSS-only errors: {len(errors)} occurrences</li>"
+                        html += f"<li>CSS-only errors: {error_count} occurrences</li>"
                     html += "</ul></div>"
             elif key == 'examples' and isinstance(value, list):
                 html += f"<strong>{key.replace('_', ' ').title()}:</strong><ul>"
@@ -738,6 +3841,9 @@ class UserFlowAnalyzer:
                             html += f"<li>User stuck on {example['stuck_on_page']} for {example['gap_minutes']:.1f} minutes</li>"
                         elif 'event_count' in example:
                             html += f"<li>Session with {example['event_count']} events ({example['duration_minutes']:.1f} minutes)</li>"
+                        elif 'other_user_ids' in example:
+                            html += (f"<li>Session {example['session_id']} used by {example['user_count']} users, "
+                                     f"including {', '.join(map(str, example['other_user_ids']))}</li>")
                 html += "</ul>"
             elif key == 'most_problematic_pages' and isinstance(value, list):
                 html += f"<strong>{key.replace('_', ' ').title()}:</strong><ul>"
@@ -754,24 +3860,175 @@ class UserFlowAnalyzer:
 
     def run_analysis(self) -> str:
         """Run complete analysis and return HTML report."""
-        self.load_data()
-        self.process_events()
-        self.analyze_flows()
-        self.detect_anomalies()
+        if self.store.streaming:
+            self.analyze_streaming()
+            return self.generate_html_report()
+
+        snapshot_key = self._snapshot_key()
+        if not self.load_snapshot(snapshot_key):
+            self.load_data()
+            self.process_events()
+            self.save_snapshot(snapshot_key)
+        self.analyze_sessions()
         return self.generate_html_report()
 
+def parse_args() -> argparse.Namespace:
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Analyze user flows and anomalies from JSON Lines events.")
+    parser.add_argument('source', nargs='?', default=DEFAULT_DATA_URL,
+                        help="URL, local JSON Lines/Parquet/Arrow file, directory or glob of shards, named pipe, "
+                             "or '-' for stdin (default: the Tandem S3 export)")
+    parser.add_argument('-o', '--output', default='user_flow_report.html',
+                        help="Path of the generated HTML report (default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Bytes read at a time from streamed inputs (default: %(default)s)")
+    parser.add_argument('--http-workers', type=int, default=1,
+                        help="Concurrent byte-range requests used to download HTTP inputs (default: %(default)s)")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="Directory caching HTTP downloads between runs (default: %(default)s)")
+    parser.add_argument('--cache-max-bytes', type=int, default=DEFAULT_CACHE_MAX_BYTES,
+                        help="Disk budget of the download cache before old entries are evicted (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Always download HTTP inputs again instead of revalidating a cached copy")
+    parser.add_argument('--snapshot-dir', default=DEFAULT_SNAPSHOT_DIR,
+                        help="Directory keeping snapshots of the parsed and grouped sessions, reused by later "
+                             "runs on the same input (default: %(default)s)")
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help="Always parse and group the input instead of reusing a snapshot")
+    parser.add_argument('--sessions-output',
+                        help="Also write the grouped, time-ordered session table to this Parquet file "
+                             "(Arrow IPC for .arrow/.feather/.ipc paths)")
+    parser.add_argument('--json-backend', choices=['auto', 'msgspec', 'orjson', 'json'], default='auto',
+                        help="JSON decoder used for each line; 'auto' picks the fastest installed (default: %(default)s)")
+    parser.add_argument('--ingest-workers', type=int, default=1,
+                        help="Processes used to parse and validate the input in parallel (default: %(default)s)")
+    parser.add_argument('--dedup', choices=['off', 'exact', 'bloom'], default='off',
+                        help="Drop events whose uuid was already seen, tracked in a set or in a fixed-size "
+                             "Bloom filter (default: %(default)s)")
+    parser.add_argument('--dedup-capacity', type=int, default=DEFAULT_DEDUP_CAPACITY,
+                        help="Distinct uuids the Bloom filter is sized for (default: %(default)s)")
+    parser.add_argument('--dedup-error-rate', type=float, default=DEFAULT_DEDUP_ERROR_RATE,
+                        help="False-positive rate of the Bloom filter at capacity (default: %(default)s)")
+    parser.add_argument('--quarantine', metavar='PATH',
+                        help="Write every rejected line to this JSON Lines file with the reasons it was rejected")
+    parser.add_argument('--sample', type=float, metavar='RATE',
+                        help="Analyze only this fraction of sessions (e.g. 0.01), picked by a hash of session_id; "
+                             "counts in the report are scaled back up with confidence intervals")
+    parser.add_argument('--store', choices=sorted(EVENT_STORES), default='memory',
+                        help="How events are held: Event objects, dictionary-encoded columns (much smaller "
+                             "on large inputs), or on disk for inputs larger than memory, as sorted runs or as "
+                             "session partitions analyzed one at a time, or streamed: each session analyzed and "
+                             "released once the time-ordered input has moved past it (default: %(default)s)")
+    parser.add_argument('--spill-dir',
+                        help="Directory for the temporary files of disk-backed stores (default: the system "
+                             "temporary directory)")
+    parser.add_argument('--sort-run-size', type=int, default=DEFAULT_SORT_RUN_SIZE,
+                        help="Events sorted in memory per on-disk run of the external store (default: %(default)s)")
+    parser.add_argument('--partitions', type=int, default=DEFAULT_PARTITIONS,
+                        help="Spill files the partitioned store hashes sessions into; memory use is about "
+                             "1/N of the input (default: %(default)s)")
+    parser.add_argument('--sessionize', choices=['off'] + list(SESSIONIZE_MODES), default='off',
+                        help="Re-cut sessions at inactivity gaps: 'split' cuts each session_id, 'derive' ignores "
+                             "session_id and cuts each user's whole event stream (default: %(default)s)")
+    parser.add_argument('--session-timeout', type=float, default=DEFAULT_SESSION_TIMEOUT / 60, metavar='MINUTES',
+                        help="Inactivity that ends a session with --sessionize or --store streaming "
+                             "(default: %(default)s)")
+    parser.add_argument('--allowed-lateness', type=float, default=DEFAULT_ALLOWED_LATENESS / 60, metavar='MINUTES',
+                        help="How far the watermark of --store streaming trails the newest event time, i.e. how "
+                             "late an event may arrive and still be in time (default: %(default)s)")
+    parser.add_argument('--late-events', choices=LATE_EVENT_POLICIES, default='drop',
+                        help="What --store streaming does with a late event that has no open session to join "
+                             "(default: %(default)s)")
+    parser.add_argument('--analyses', type=lambda value: [name.strip() for name in value.split(',') if name.strip()],
+                        metavar='NAMES',
+                        help="Comma-separated analysis plugins to run (default: all registered ones: "
+                             f"{', '.join(ANALYSIS_PLUGINS)})")
+    parser.add_argument('--plugin', action='append', default=[], metavar='MODULE',
+                        help="Import this module (a name importable from the working directory, or a .py file) "
+                             "before the analysis so that the plugins it registers with @register_analysis run "
+                             "too (repeatable)")
+    parser.add_argument('--benchmark', choices=['decoders', 'timestamps'],
+                        help="Measure ingestion micro-benchmarks on the first lines of the source instead of "
+                             "generating a report")
+    parser.add_argument('--benchmark-lines', type=int, default=100000,
+                        help="Number of input lines used by --benchmark (default: %(default)s)")
+    args = parser.parse_args()
+    if args.store == 'streaming' and args.sessionize != 'off':
+        parser.error("--sessionize cannot re-cut the sessions that --store streaming closes as it reads")
+    if args.store == 'streaming' and args.sessions_output:
+        parser.error("--sessions-output needs the grouped sessions, which --store streaming does not keep")
+    return args
+
+def run_benchmark(name: str, source: InputSource, max_lines: int) -> None:
+    """Print the results of one micro-benchmark run on a sample of the source lines."""
+    lines = [line for line in itertools.islice(source.iter_lines(), max_lines) if line and not line.isspace()]
+    print(f"Benchmarking on {len(lines)} lines from {source.description}")
+
+    if name == 'decoders':
+        for backend, lines_per_second in benchmark_json_decoders(lines):
+            print(f"  {backend:<10} {lines_per_second:>14,.0f} lines/s")
+    elif name == 'timestamps':
+        decode = make_json_decoder().decode
+        event_times = []
+        for line in lines:
+            try:
+                fields = decode(line)
+            except Exception:
+                continue
+            if fields is not None and isinstance(fields[3], str):
+                event_times.append(fields[3])
+
+        for strategy, values_per_second in benchmark_timestamp_parsers(event_times):
+            print(f"  {strategy:<12} {values_per_second:>14,.0f} timestamps/s")
+
 def main():
     """Main function to run the analysis."""
-    data_url = "https://s3.eu-central-1.amazonaws.com/public.prod.usetandem.ai/sessions.json"
-
-    analyzer = UserFlowAnalyzer(data_url)
-    html_report = analyzer.run_analysis()
+    args = parse_args()
+
+    # Plugin modules import this script as 'user_flow_analyzer': make that the running module, not a second copy
+    sys.modules.setdefault('user_flow_analyzer', sys.modules[__name__])
+    for plugin in args.plugin:
+        import_plugin(plugin)
+
+    cache = None if args.no_cache else DownloadCache(args.cache_dir, args.cache_max_bytes)
+    # The watermark of the streaming store assumes lines in file order
+    source = open_source(args.source, args.chunk_size, http_workers=args.http_workers, cache=cache,
+                         in_order=args.store == 'streaming')
+    if args.benchmark:
+        run_benchmark(args.benchmark, source, args.benchmark_lines)
+        return
+
+    snapshots = None if args.no_snapshot else SnapshotCache(args.snapshot_dir)
+    quarantine = QuarantineWriter(args.quarantine) if args.quarantine else None
+    derive = args.sessionize == 'derive'
+    store = make_event_store(args.store, args.spill_dir, args.sort_run_size, args.partitions, group_by_user=derive,
+                             session_timeout=args.session_timeout * 60,
+                             allowed_lateness=args.allowed_lateness * 60, late_policy=args.late_events)
+    if args.sessionize != 'off':
+        store = SessionizedEventStore(store, Sessionizer(args.sessionize, args.session_timeout * 60))
+    # Derived sessions span several session_ids, so whole users are sampled instead
+    sampler = None
+    if args.sample is not None:
+        sampler = SessionSampler(args.sample, key='user_id' if derive else 'session_id')
+    analyzer = UserFlowAnalyzer(source, json_backend=args.json_backend, store=store,
+                                ingest_workers=args.ingest_workers, snapshots=snapshots,
+                                deduplicator=make_deduplicator(args.dedup, args.dedup_capacity,
+                                                               args.dedup_error_rate),
+                                quarantine=quarantine, sampler=sampler, analyses=args.analyses)
+    try:
+        html_report = analyzer.run_analysis()
+    finally:
+        if quarantine is not None:
+            quarantine.close()
 
     # Save report to file
-    with open('user_flow_report.html', 'w', encoding='utf-8') as f:
+    with open(args.output, 'w', encoding='utf-8') as f:
         f.write(html_report)
 
-    print("Analysis complete! Report saved to 'user_flow_report.html'")
+    print(f"Analysis complete! Report saved to '{args.output}'")
+    if args.sessions_output:
+        row_count = write_session_table(analyzer.store, args.sessions_output)
+        print(f"Session table with {row_count} events saved to '{args.sessions_output}'")
     print(f"Found {len(analyzer.flows)} meaningful flows and {len(analyzer.anomalies)} anomalies")
 
 if __name__ == "__main__":
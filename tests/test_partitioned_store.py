@@ -0,0 +1,50 @@
+"""PartitionedEventStore counts, which are only known once its spill files have been read."""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sources'))
+
+from user_flow_analyzer import PartitionedEventStore, UserFlowAnalyzer  # noqa: E402
+
+
+class PartitionedEventStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'events.jsonl')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for i in range(120):
+                f.write(json.dumps({
+                    'uuid': f'e{i}', 'user_id': f'u{i % 4}', 'session_id': f's{i % 12}',
+                    'event_time': f'2025-02-06 10:{i // 60:02d}:{i % 60:02d}', 'path': f'/page{i % 3}',
+                    'css': '.btn', 'text': 'Click', 'value': ''
+                }) + '\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_analysis(self, analyses):
+        store = PartitionedEventStore(partitions=3, directory=self.directory.name)
+        analyzer = UserFlowAnalyzer(self.path, store=store, analyses=analyses)
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = analyzer.run_analysis()
+        return store, report
+
+    def test_counts_after_analysis(self):
+        store, _ = self.run_analysis(None)
+        self.assertEqual((store.event_count, store.user_count, store.session_count), (120, 4, 12))
+
+    def test_sessions_counted_without_analyses(self):
+        store, report = self.run_analysis([])
+        self.assertEqual(store.session_count, 12)
+        self.assertIn('<div class="summary-number">3.0</div>', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
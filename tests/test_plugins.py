@@ -0,0 +1,57 @@
+"""--plugin modules loaded by name from the working directory or by file path."""
+
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sources'))
+
+from user_flow_analyzer import ANALYSIS_PLUGINS, import_plugin  # noqa: E402
+
+PLUGIN_SOURCE = textwrap.dedent("""
+    from user_flow_analyzer import AnalysisPlugin, register_analysis
+
+    @register_analysis
+    class PageCounts(AnalysisPlugin):
+        name = 'test_page_counts'
+        scope = 'event'
+        fields = ('path',)
+
+        def visit_event(self, user_id, session_id, event):
+            pass
+
+        def finish(self):
+            pass
+""")
+
+
+class ImportPluginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, 'test_detectors.py'), 'w', encoding='utf-8') as f:
+            f.write(PLUGIN_SOURCE)
+        self.cwd = os.getcwd()
+        self.sys_path = list(sys.path)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.path[:] = self.sys_path
+        sys.modules.pop('test_detectors', None)
+        ANALYSIS_PLUGINS.pop('test_page_counts', None)
+        self.directory.cleanup()
+
+    def test_module_name_found_in_working_directory(self):
+        os.chdir(self.directory.name)
+        import_plugin('test_detectors')
+        self.assertIn('test_page_counts', ANALYSIS_PLUGINS)
+
+    def test_file_path(self):
+        import_plugin(os.path.join(self.directory.name, 'test_detectors.py'))
+        self.assertIn('test_page_counts', ANALYSIS_PLUGINS)
+
+
+if __name__ == '__main__':
+    unittest.main()
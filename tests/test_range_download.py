@@ -0,0 +1,149 @@
+"""RangeHttpSource against a local http.server stand-in for the S3 export."""
+
+import contextlib
+import gzip
+import io
+import http.server
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sources'))
+
+from user_flow_analyzer import (CachedHttpSource, DownloadCache, MAGIC_LENGTH, RangeHttpSource,  # noqa: E402
+                                StreamingEventStore, UserFlowAnalyzer)
+
+
+def make_payload(line_count: int = 200) -> bytes:
+    """JSON Lines of varying lengths, without a newline after the last one."""
+    lines = [f'{{"uuid": "{i}", "user_id": "u{i % 7}", "text": "{"x" * (i % 53)}"}}' for i in range(line_count)]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def make_events(event_count: int = 300) -> bytes:
+    """Time-ordered events one minute apart, interleaving the sessions of ten users."""
+    lines = [f'{{"uuid": "e{i}", "user_id": "u{i % 10}", "session_id": "s{i % 10}", '
+             f'"event_time": "2025-02-06 {i // 60:02d}:{i % 60:02d}:00", "path": "/page{i % 3}", '
+             f'"css": ".btn", "text": "Click", "value": ""}}' for i in range(event_count)]
+    return '\n'.join(lines).encode('utf-8')
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.payloads` by path, honouring single byte ranges, If-Range and If-None-Match like S3."""
+
+    def do_GET(self):
+        server = self.server
+        body = server.payloads[self.path]
+        etag = server.etag
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        requested = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+
+        if requested and server.supports_ranges and (if_range is None or if_range == etag):
+            start, end = int(requested.group(1)), min(int(requested.group(2)), len(body) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+        # The object is replaced right after the probe of a download
+        if requested and int(requested.group(2)) == MAGIC_LENGTH - 1 and server.change_after_probe:
+            server.etag = '"v2"'
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHttpSourceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.payload = make_payload()
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        cls.server.payloads = {
+            '/sessions.jsonl': cls.payload,
+            '/sessions.jsonl.gz': gzip.compress(cls.payload),
+            '/events.jsonl': make_events(),
+        }
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.etag = '"v1"'
+        self.server.supports_ranges = True
+        self.server.change_after_probe = False
+
+    def source(self, path: str, segment_size: int, in_order: bool = False) -> RangeHttpSource:
+        host, port = self.server.server_address
+        return RangeHttpSource(f'http://{host}:{port}{path}', workers=3, segment_size=segment_size,
+                               in_order=in_order)
+
+    def expected_lines(self):
+        return self.payload.split(b'\n')
+
+    def test_lines_cut_at_segment_boundaries_are_stitched(self):
+        for segment_size in (37, 1000, len(self.payload) + 10):
+            with self.subTest(segment_size=segment_size):
+                lines = [bytes(line) for line in self.source('/sessions.jsonl', segment_size).iter_lines()]
+                # Whole lines are handed out as their segment arrives, so only the multiset is fixed
+                self.assertEqual(sorted(lines), sorted(self.expected_lines()))
+
+    def test_gzip_segments_are_decompressed_in_order(self):
+        lines = [bytes(line) for line in self.source('/sessions.jsonl.gz', 100).iter_lines()]
+        self.assertEqual(lines, self.expected_lines())
+
+    def test_server_without_range_support_falls_back_to_one_request(self):
+        self.server.supports_ranges = False
+        lines = [bytes(line) for line in self.source('/sessions.jsonl', 37).iter_lines()]
+        self.assertEqual(lines, self.expected_lines())
+
+    def test_object_changed_during_download_fails(self):
+        self.server.change_after_probe = True
+        with self.assertRaisesRegex(RuntimeError, 'changed or was not honoured'):
+            list(self.source('/sessions.jsonl', 1000).iter_lines())
+
+    def test_streaming_store_gets_segments_in_order(self):
+        store = StreamingEventStore()
+        analyzer = UserFlowAnalyzer(self.source('/events.jsonl', 500, in_order=True), store=store)
+        with contextlib.redirect_stdout(io.StringIO()):
+            analyzer.run_analysis()
+        # Out-of-order segments would move the watermark ahead and drop in-time events as late
+        self.assertEqual(store.late_events, 0)
+        self.assertEqual(store.event_count, 300)
+
+    def test_cache_is_filled_while_segments_are_parsed(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = DownloadCache(cache_dir)
+
+        source = CachedHttpSource(self.source('/sessions.jsonl', 37), cache)
+        lines = [bytes(line) for line in source.iter_lines()]
+        self.assertEqual(sorted(lines), sorted(self.expected_lines()))
+        self.assertFalse(source.cache_hit)
+        with open(cache.lookup(source.origin.url)['path'], 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+        source = CachedHttpSource(self.source('/sessions.jsonl', 37), cache)
+        self.assertEqual([bytes(line) for line in source.iter_lines()], self.expected_lines())
+        self.assertTrue(source.cache_hit)
+
+
+if __name__ == '__main__':
+    unittest.main()